@@ -5,6 +5,16 @@ import re
 from io import BytesIO
 import xlsxwriter
 import zipfile
+import os
+import itertools
+import tempfile
+from functools import partial
+
+from brand_matcher import (
+    MATCH_KIND_LABELS, BrandIndex, BrandLexicon, MatchState, compile_regex_rule, match_keyword_chunks,
+    normalize_series, parse_exclusion_rules, parse_manual_rules, parse_priorities, parse_regex_rules,
+    parse_rule_priorities, read_keyword_chunks, result_columns, share_of_search, table_fingerprint, token_frequencies
+)
 
 # 设置页面配置
 st.set_page_config(
@@ -13,15 +23,32 @@ st.set_page_config(
     layout="wide"
 )
 
+# 手动规则表的列
+RULE_COLUMNS = ['品牌名称', '匹配关键词', '排除关键词', '规则类型', '优先级']
+
 # 初始化session state
 if 'custom_rules' not in st.session_state:
-    st.session_state.custom_rules = pd.DataFrame(columns=['品牌名称', '匹配关键词'])
+    st.session_state.custom_rules = pd.DataFrame(columns=RULE_COLUMNS)
 if 'product_data' not in st.session_state:
     st.session_state.product_data = None
 if 'brand_data' not in st.session_state:
     st.session_state.brand_data = None
 if 'matched_results' not in st.session_state:
     st.session_state.matched_results = None
+if 'match_stats' not in st.session_state:
+    st.session_state.match_stats = None
+if 'all_matches' not in st.session_state:
+    st.session_state.all_matches = None
+if 'match_state' not in st.session_state:
+    st.session_state.match_state = None
+if 'rematch_pending' not in st.session_state:
+    st.session_state.rematch_pending = False
+if 'brand_key' not in st.session_state:
+    st.session_state.brand_key = None
+if 'parent_share' not in st.session_state:
+    st.session_state.parent_share = None
+if 'stream_result' not in st.session_state:
+    st.session_state.stream_result = None
 
 def process_product_data(df):
     """处理产品数据，计算排名和累计占比"""
@@ -53,8 +80,42 @@ def process_product_data(df):
     df_sorted['月搜索量累计占比'] = df_sorted['月搜索量累计和'] / df_sorted['月搜索量'].sum()
     return df_sorted
 
-def match_brands(product_df, brand_df, custom_rules_df):
-    """执行品牌匹配逻辑"""
+@st.cache_data(max_entries=4, show_spinner=False)
+def get_normalized_keywords(product_key, _keywords):
+    """规范化关键词列，按关键词列的内容指纹缓存，重复运行时不再重新计算"""
+    return normalize_series(_keywords)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def get_token_frequencies(product_key, cjk, _keywords):
+    """统计规范化关键词的整词文档频率，按关键词列的内容指纹缓存"""
+    return token_frequencies(_keywords, cjk)
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def get_brand_lexicon(engine, cjk, variants, demoted, rules_key, brand_key, _custom_rules_df, _brand_df):
+    """编译手动规则和品牌词库，按两者的内容指纹缓存，只有内容变化时才重新构建
+
+    demoted 为需要降级的品牌词元组（见 BrandLexicon），参与缓存键。
+    """
+    manual_map = parse_manual_rules(_custom_rules_df)
+    exclusions = parse_exclusion_rules(_custom_rules_df)
+    regex_rules = parse_regex_rules(_custom_rules_df)
+    priorities = parse_rule_priorities(_custom_rules_df)
+    brand_index = BrandIndex(
+        _brand_df['品牌名称'],
+        parse_priorities(_brand_df),
+        _brand_df.get('别名'),
+        _brand_df.get('母公司')
+    )
+    return BrandLexicon(manual_map, brand_index, engine, cjk, variants, exclusions, regex_rules, priorities, demoted)
+
+def lexicon_columns(brand_df):
+    """返回品牌词库中参与匹配的列，用于计算词库指纹"""
+    return [column for column in ['品牌名称', '优先级', '别名', '母公司'] if column in brand_df.columns]
+
+def match_brands(product_df, brand_df, custom_rules_df, engine='aho', workers=1, incremental=True, all_matches=False,
+                 resolve='priority', fuzzy=0, cjk=False, variants=False, collapse=False, ambiguity=0.0,
+                 ambiguity_action='flag'):
+    """执行品牌匹配逻辑，各参数对应侧边栏的匹配设置"""
     # 数据验证
     if product_df is None or product_df.empty:
         st.error("❌ 产品数据为空")
@@ -66,71 +127,110 @@ def match_brands(product_df, brand_df, custom_rules_df):
     
     # 准备数据
     result_df = product_df[['关键词', '月搜索量']].copy()
-    result_df['keyword_lower'] = result_df['关键词'].astype(str).str.lower()
-    
-    # 准备品牌词（转小写）
-    brand_list = brand_df['品牌名称'].astype(str).str.lower().tolist()
-    
-    # 准备手动规则
-    manual_map = {}
-    if not custom_rules_df.empty:
-        for _, row in custom_rules_df.iterrows():
-            brand_name = str(row['品牌名称'])
-            keywords = [kw.strip().lower() for kw in str(row['匹配关键词']).split(',') if kw.strip()]
-            for kw in keywords:
-                manual_map[kw] = brand_name
-    
-    # 执行匹配
-    result_df['品牌名称'] = None
-    result_df['品牌'] = None
-    result_df['词性'] = 'Non-Branded KWs'
-    
-    for idx, row in result_df.iterrows():
-        keyword_lower = row['keyword_lower']
-        matched_brand = None
-        matched_term = None
-        
-        # 1. 优先检查手动规则（精准匹配，整词匹配）
-        for manual_kw, manual_brand in manual_map.items():
-            if manual_kw:
-                # 使用正则整词匹配，忽略大小写
-                pattern = r'(?<!\w)' + re.escape(manual_kw) + r'(?!\w)'
-                if re.search(pattern, keyword_lower, re.IGNORECASE):
-                    matched_brand = manual_brand
-                    matched_term = manual_kw
-                    break
-        
-        # 2. 如果手动规则没匹配到，检查品牌词库（精准匹配，整词匹配）
-        if not matched_brand:
-            for brand in brand_list:
-                if brand:
-                    pattern = r'(?<!\w)' + re.escape(brand) + r'(?!\w)'
-                    if re.search(pattern, keyword_lower, re.IGNORECASE):
-                        # 找到对应的原始品牌名称
-                        original_brand = brand_df[brand_df['品牌名称'].str.lower() == brand]['品牌名称'].iloc[0]
-                        matched_brand = original_brand
-                        matched_term = brand
-                        break
-        
-        # 3. 更新结果
-        if matched_brand:
-            result_df.at[idx, '品牌名称'] = matched_brand
-            result_df.at[idx, '品牌'] = matched_term
-            result_df.at[idx, '词性'] = 'Branded KWs'
+    product_key = table_fingerprint(result_df[['关键词']])
+    normalized = get_normalized_keywords(product_key, result_df['关键词'])
+    
+    # 获取编译好的匹配词表（规则或词库未变化时直接复用缓存）；
+    # cjk 时中日韩文字按子串匹配，variants 时同时编入品牌词的复数变体
+    rules_key = table_fingerprint(custom_rules_df)
+    brand_key = table_fingerprint(brand_df[lexicon_columns(brand_df)])
+    lexicon = get_brand_lexicon(engine, cjk, variants, (), rules_key, brand_key, custom_rules_df, brand_df)
+    
+    # 歧义词：按关键词语料的整词文档频率一次算出全部词条的得分，超过阈值（0～1，0 为关闭）的标记，
+    # ambiguity_action 为 demote 时同时降级到其他品牌词之后
+    frequencies = get_token_frequencies(product_key, cjk, normalized)
+    ambiguous = set()
+    if ambiguity > 0:
+        ambiguous = lexicon.ambiguous_terms(lexicon.ambiguity_scores(frequencies), ambiguity)
+        if ambiguity_action == 'demote' and ambiguous:
+            lexicon = get_brand_lexicon(
+                engine, cjk, variants, tuple(sorted(ambiguous)), rules_key, brand_key, custom_rules_df, brand_df
+            )
+    
+    term_ambiguous = np.array(
+        [term in ambiguous and source == 1 for term, source in zip(lexicon.terms, lexicon.sources)] + [False]
+    )
+    
+    # 执行匹配：相同关键词只匹配一次，命中词条序号回填到每一行，未命中为 -1（对应末尾的 None 占位）；
+    # resolve、fuzzy、collapse 的含义见 MatchState，all_matches 时保留全部命中供长表展示
+    state = st.session_state.match_state
+    reusable = (
+        state is not None and state.key == product_key and state.resolve == resolve and state.fuzzy == fuzzy
+        and state.collapse == collapse and state.lexicon.cjk == cjk
+        and (state.collect_all or not all_matches)
+    )
+    if incremental and reusable:
+        # 关键词未变化：沿用上次结果，只重新匹配受影响的关键词
+        rematched = state.rematch(lexicon, workers=workers)
+    else:
+        state = MatchState(
+            normalized, lexicon, workers=workers, key=product_key,
+            collect_all=all_matches, resolve=resolve, fuzzy=fuzzy, collapse=collapse
+        )
+        rematched = None
+    st.session_state.match_state = state
+    
+    if state.exhausted_rules:
+        st.warning(f"⚠️ 以下正则规则匹配超时，本次匹配未使用：{', '.join(state.exhausted_rules)}")
+    
+    hit_ids = state.hit_ids
+    unique_count = len(state.uniques)
+    st.session_state.match_stats = {
+        'total_rows': len(result_df),
+        'unique_keywords': unique_count,
+        'saved_rows': len(result_df) - unique_count,
+        'rematched_keywords': rematched,
+        'prefiltered_keywords': state.prefiltered if rematched is None else None,
+        'ambiguous_terms': len(ambiguous),
+    }
+    
+    # 一次性生成结果列；置信度的词条特征在编译后一次算好，再按每个去重关键词的命中方式和位置向量化计算
+    term_confidence = lexicon.term_confidence(lexicon.ambiguity_scores(frequencies))
+    for column, values in result_columns(state, term_confidence).items():
+        result_df[column] = values
+    if ambiguity > 0:
+        result_df['歧义词'] = term_ambiguous[hit_ids]
+    
+    # 母公司汇总：词条的母公司编码已在编译时算好，按编码分组求和即可得到搜索量份额
+    if lexicon.has_parents:
+        parent_codes = np.append(lexicon.parent_codes, -1)[hit_ids]
+        result_df['母公司'] = np.array(lexicon.parent_names + [None], dtype=object)[parent_codes]
+        volumes = pd.to_numeric(result_df['月搜索量'], errors='coerce').fillna(0).to_numpy()
+        st.session_state.parent_share = share_of_search(parent_codes, volumes, lexicon.parent_names).rename(
+            columns={'name': '母公司', 'volume': '月搜索量', 'share': '搜索量份额'}
+        )
+    else:
+        st.session_state.parent_share = None
+    
+    # 全部品牌命中长表：每行一个命中，起止位置基于规范化后的关键词（一并输出，便于对照）
+    if all_matches:
+        long_hits = state.row_hits()
+        rows = long_hits['row'].to_numpy()
+        long_ids = long_hits['term_id'].to_numpy()
+        term_kinds = np.array([MATCH_KIND_LABELS[kind] for kind in lexicon.kinds], dtype=object)
+        st.session_state.all_matches = pd.DataFrame({
+            '关键词': result_df['关键词'].to_numpy()[rows],
+            '规范化关键词': normalized.to_numpy()[rows],
+            '月搜索量': result_df['月搜索量'].to_numpy()[rows],
+            '品牌名称': np.array(lexicon.brands, dtype=object)[long_ids],
+            '品牌': np.array(lexicon.terms, dtype=object)[long_ids],
+            '匹配方式': term_kinds[long_ids],
+            '起始位置': long_hits['start'].to_numpy(),
+            '结束位置': long_hits['end'].to_numpy(),
+        })
+    else:
+        st.session_state.all_matches = None
     
     # 添加特性参数列
     result_df['特性参数'] = None
     
-    # 清理临时列
-    result_df = result_df.drop('keyword_lower', axis=1)
-    
     return result_df
 
-def create_download_file(df):
+def create_download_file(df, sheet_name='品牌匹配结果'):
     """创建Excel下载文件"""
     output = BytesIO()
     with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name='品牌匹配结果', index=False)
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
     return output.getvalue()
 
 # 主界面
@@ -154,7 +254,7 @@ with st.sidebar:
     brand_file = st.file_uploader(
         "上传欧鹭品牌词数据文件",
         type=['xlsx', 'xls'],
-        help="请上传包含品牌名称的Excel文件"
+        help="请上传包含品牌名称的Excel文件，可选“优先级”列（数字越小越优先）、“别名”列（英文逗号分隔，命中后归入该品牌）和“母公司”列"
     )
     
     st.header("⚙️ 手动规则配置")
@@ -162,16 +262,42 @@ with st.sidebar:
     # 手动添加品牌规则
     with st.form("add_rule_form"):
         custom_brand = st.text_input("归属品牌名")
-        custom_keywords = st.text_input("匹配关键词（英文逗号分隔）")
+        rule_type = st.radio(
+            "规则类型",
+            ["关键词", "正则"],
+            horizontal=True,
+            help="正则规则整体作为一个表达式（忽略大小写），如 `anker\\s?\\d{3}`；命中同样需要满足整词边界"
+        )
+        custom_keywords = st.text_input("匹配关键词（关键词规则用英文逗号分隔，正则规则填写一个表达式）")
+        custom_excludes = st.text_input(
+            "排除关键词（英文逗号分隔，可选）",
+            help="品牌命中落在这些短语之内时不计为该品牌，如 Apple 品牌排除 apple cider；只填排除关键词时作用于词库中的同名品牌"
+        )
+        custom_priority = st.number_input(
+            "优先级",
+            value=0,
+            step=1,
+            help="数字越小越优先；与品牌文件的“优先级”列统一比较，相同优先级时手动规则先于品牌词库"
+        )
         submitted = st.form_submit_button("添加品牌规则")
         
-        if submitted and custom_brand and custom_keywords:
-            new_rule = pd.DataFrame({
-                '品牌名称': [custom_brand],
-                '匹配关键词': [custom_keywords]
-            })
-            st.session_state.custom_rules = pd.concat([st.session_state.custom_rules, new_rule], ignore_index=True)
-            st.success("规则添加成功！")
+        if submitted and custom_brand and (custom_keywords or custom_excludes):
+            try:
+                if rule_type == "正则" and custom_keywords:
+                    compile_regex_rule(custom_keywords)
+            except ValueError as e:
+                st.error(f"❌ {e}")
+            else:
+                new_rule = pd.DataFrame({
+                    '品牌名称': [custom_brand],
+                    '匹配关键词': [custom_keywords],
+                    '排除关键词': [custom_excludes],
+                    '规则类型': [rule_type],
+                    '优先级': [int(custom_priority)]
+                })
+                st.session_state.custom_rules = pd.concat([st.session_state.custom_rules, new_rule], ignore_index=True)
+                st.session_state.rematch_pending = True
+                st.success("规则添加成功！")
     
     # 显示自定义规则
     if not st.session_state.custom_rules.empty:
@@ -179,7 +305,8 @@ with st.sidebar:
         st.dataframe(st.session_state.custom_rules, hide_index=True)
         
         if st.button("清空所有规则"):
-            st.session_state.custom_rules = pd.DataFrame(columns=['品牌名称', '匹配关键词'])
+            st.session_state.custom_rules = pd.DataFrame(columns=RULE_COLUMNS)
+            st.session_state.rematch_pending = True
             st.rerun()
 
 # 处理文件上传
@@ -215,10 +342,28 @@ if brand_file:
             st.error("❌ 文件必须包含'品牌名称'列")
             st.info("💡 请确保Excel文件包含正确的列名")
         else:
-            # 过滤空值并去重
+            # 过滤空值并去重，同名品牌保留优先级最高（数字最小）的一行
+            previous_brand_data = st.session_state.brand_data
+            if '优先级' in brand_df.columns:
+                brand_df = brand_df.assign(优先级=parse_priorities(brand_df)).sort_values('优先级', kind='stable')
             st.session_state.brand_data = brand_df.dropna(subset=['品牌名称']).drop_duplicates(subset=['品牌名称']).reset_index(drop=True)
             st.success("✅ 品牌词数据文件上传成功！")
             
+            # 词库与上次不同时提示差异，并在已有匹配结果上增量更新
+            brand_key = table_fingerprint(st.session_state.brand_data[lexicon_columns(st.session_state.brand_data)])
+            if st.session_state.brand_key is not None and brand_key != st.session_state.brand_key:
+                old_terms = set(BrandIndex(previous_brand_data['品牌名称']).canonical)
+                new_terms = set(BrandIndex(st.session_state.brand_data['品牌名称']).canonical)
+                st.info(f"🔄 品牌词库已更新：新增 {len(new_terms - old_terms)} 个品牌词，删除 {len(old_terms - new_terms)} 个品牌词")
+                st.session_state.rematch_pending = True
+            st.session_state.brand_key = brand_key
+            
+            # 提示大小写不同但小写后相同的品牌名称
+            collisions = BrandIndex(st.session_state.brand_data['品牌名称']).collisions
+            if collisions:
+                collision_text = '；'.join(' / '.join(names) for names in collisions.values())
+                st.warning(f"⚠️ 以下品牌名称规范化（大小写、全半角、重音等）后相同，匹配结果将统一归属到首次出现的写法：{collision_text}")
+            
     except Exception as e:
         st.error(f"❌ 品牌词数据文件读取失败：{str(e)}")
         st.info("💡 请确保文件是有效的Excel格式(.xlsx或.xls)")
@@ -279,6 +424,89 @@ with tab2:
 with tab3:
     st.header("品牌匹配结果")
     
+    # 匹配引擎选择
+    engine_options = {
+        "Aho-Corasick 自动机": "aho",
+        "前缀树合并正则": "trie_regex",
+        "分词哈希查表": "ngram",
+        "逐条正则（原始方式）": "regex",
+    }
+    col1, col2 = st.columns(2)
+    with col1:
+        engine_label = st.selectbox(
+            "匹配引擎",
+            options=list(engine_options.keys()),
+            help="各引擎匹配结果一致，仅速度不同"
+        )
+    with col2:
+        match_workers = st.number_input(
+            "并行进程数",
+            min_value=1,
+            max_value=os.cpu_count() or 1,
+            value=1,
+            help="关键词较多时分块并行匹配，关键词较少时自动在当前进程串行匹配"
+        )
+    
+    resolve_options = {
+        "按词库顺序（优先级数字小者优先，同级手动规则优先，其次品牌文件行顺序）": "priority",
+        "最左最长（优先级、手动规则优先，其次位置最靠前、词最长）": "leftmost_longest",
+    }
+    resolve_label = st.radio(
+        "多品牌命中时的归属规则",
+        options=list(resolve_options.keys()),
+        help="优先级来自手动规则和品牌文件中的“优先级”列（缺省为 0）；最左最长规则下 soundcore 优先于 sound，结果不受品牌文件行顺序影响"
+    )
+    fuzzy_options = {"关闭": 0, "容错 1 个字符": 1, "容错 2 个字符": 2}
+    fuzzy_label = st.select_slider(
+        "模糊匹配（拼写容错）",
+        options=list(fuzzy_options.keys()),
+        help="仅对没有精确命中的关键词生效；4～7 个字符的品牌词最多容错 1 个字符，8 个字符以上最多 2 个"
+    )
+    cjk = st.checkbox(
+        "中日韩文字按子串匹配",
+        help="中文、日文、韩文没有空格分词，开启后“安克”可以命中“安克充电器”，英文等仍按整词匹配"
+    )
+    variants = st.checkbox(
+        "匹配品牌词复数变体",
+        help="同时匹配品牌词的复数形式（如 ankers、boxes），命中归入原品牌；所有格和连字符后缀（anker's、anker-branded）本身即可命中"
+    )
+    collapse = st.checkbox(
+        "忽略空格和连字符",
+        help="去掉空格和连字符后再匹配，如 sound core、sound-core 都能命中 soundcore；最左最长模式下折叠命中更长时优先于精确命中（sound core 归入 soundcore 而不是 sound）"
+    )
+    ambiguity_percent = st.slider(
+        "歧义词阈值（关键词占比 %，0 为关闭）",
+        min_value=0.0,
+        max_value=50.0,
+        value=0.0,
+        step=0.5,
+        help="品牌词库中出现在超过该比例关键词里的词（如 usb、pro、max）视为通用词，在结果“歧义词”列中标记"
+    )
+    ambiguity_actions = {"仅标记": "flag", "标记并降级": "demote"}
+    ambiguity_label = st.radio(
+        "歧义词处理方式",
+        options=list(ambiguity_actions.keys()),
+        horizontal=True,
+        disabled=ambiguity_percent == 0,
+        help="降级后歧义词排在其他品牌词之后，同一关键词中有其他品牌时归属其他品牌"
+    )
+    all_matches = st.checkbox(
+        "同时输出全部品牌命中（长表）",
+        help="保留每个关键词中出现的所有品牌及其起止位置，用于竞品重叠分析"
+    )
+    match_options = {
+        'engine': engine_options[engine_label],
+        'workers': int(match_workers),
+        'all_matches': all_matches,
+        'resolve': resolve_options[resolve_label],
+        'fuzzy': fuzzy_options[fuzzy_label],
+        'cjk': cjk,
+        'variants': variants,
+        'collapse': collapse,
+        'ambiguity': ambiguity_percent / 100,
+        'ambiguity_action': ambiguity_actions[ambiguity_label],
+    }
+    
     # 运行匹配按钮
     if st.button("🚀 运行品牌匹配", type="primary", use_container_width=True):
         if st.session_state.product_data is not None and st.session_state.brand_data is not None:
@@ -286,11 +514,25 @@ with tab3:
                 st.session_state.matched_results = match_brands(
                     st.session_state.product_data,
                     st.session_state.brand_data,
-                    st.session_state.custom_rules
+                    st.session_state.custom_rules,
+                    **match_options
                 )
             st.success("✅ 品牌匹配完成！")
         else:
             st.error("❌ 请先上传产品关键词文件和品牌词数据文件")
+        st.session_state.rematch_pending = False
+    
+    # 手动规则或品牌词库变化后，在已有结果上增量更新
+    if st.session_state.rematch_pending and st.session_state.matched_results is not None:
+        if st.session_state.product_data is not None and st.session_state.brand_data is not None:
+            with st.spinner("规则或品牌词库已变化，正在增量更新匹配结果..."):
+                st.session_state.matched_results = match_brands(
+                    st.session_state.product_data,
+                    st.session_state.brand_data,
+                    st.session_state.custom_rules,
+                    **match_options
+                )
+        st.session_state.rematch_pending = False
     
     # 显示匹配结果
     if st.session_state.matched_results is not None:
@@ -309,6 +551,17 @@ with tab3:
         with col4:
             st.metric("品牌词占比", f"{branded_keywords/total_keywords*100:.1f}%")
         
+        # 去重匹配统计
+        if st.session_state.match_stats:
+            stats = st.session_state.match_stats
+            st.caption(f"🔁 去重后实际匹配 {stats['unique_keywords']:,} 个关键词，节省 {stats['saved_rows']:,} 行重复匹配")
+            if stats.get('prefiltered_keywords'):
+                st.caption(f"🧹 {stats['prefiltered_keywords']:,} 个关键词不含任何品牌词中的单词，已直接判定为非品牌词，未送入匹配引擎")
+            if stats.get('rematched_keywords') is not None:
+                st.caption(f"⚡ 增量匹配：本次仅重新匹配 {stats['rematched_keywords']:,} 个受规则或词库变化影响的关键词")
+            if stats.get('ambiguous_terms'):
+                st.caption(f"🔎 {stats['ambiguous_terms']:,} 个品牌词超过歧义词阈值，命中已在“歧义词”列中标记")
+        
         # 筛选选项
         col1, col2 = st.columns(2)
         with col1:
@@ -322,8 +575,19 @@ with tab3:
                 options=["全部"] + list(st.session_state.matched_results['品牌名称'].dropna().unique())
             )
         
+        min_confidence = st.slider(
+            "最低置信度",
+            min_value=0.0,
+            max_value=1.0,
+            value=0.0,
+            step=0.05,
+            help="置信度综合匹配方式（手动规则/精确/变体/折叠/模糊）、品牌词长度、在关键词中的位置和歧义程度；只筛选已有结果，无需重新匹配"
+        )
+        
         # 应用筛选
         filtered_results = st.session_state.matched_results.copy()
+        if min_confidence > 0 and '置信度' in filtered_results.columns:
+            filtered_results = filtered_results[filtered_results['置信度'] >= min_confidence]
         if word_type_filter != "全部":
             filtered_results = filtered_results[filtered_results['词性'] == word_type_filter]
         if brand_filter != "全部":
@@ -346,8 +610,101 @@ with tab3:
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                 use_container_width=True
             )
+        
+        # 全部品牌命中长表
+        if st.session_state.parent_share is not None:
+            st.subheader("母公司搜索量份额")
+            st.dataframe(
+                st.session_state.parent_share,
+                hide_index=True,
+                use_container_width=True,
+                column_config={'搜索量份额': st.column_config.NumberColumn(format="percent")}
+            )
+        
+        if st.session_state.all_matches is not None:
+            all_matches_df = st.session_state.all_matches
+            st.subheader("全部品牌命中")
+            brands_per_keyword = all_matches_df.groupby('关键词')['品牌名称'].nunique()
+            st.metric("包含多个品牌的关键词", int((brands_per_keyword > 1).sum()))
+            st.caption("起止位置对应“规范化关键词”列（全角转半角、转小写、去重音、合并空白后的关键词）")
+            st.dataframe(all_matches_df, hide_index=True, use_container_width=True)
+            st.download_button(
+                label="下载全部品牌命中Excel文件",
+                data=create_download_file(all_matches_df, sheet_name='全部品牌命中'),
+                file_name=f"全部品牌命中_{pd.Timestamp.now().strftime('%Y%m%d')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                use_container_width=True
+            )
     else:
         st.info("请点击'运行品牌匹配'按钮开始匹配")
+    
+    # 大文件流式匹配：逐块读取、匹配并写出，不把整个关键词文件读入内存
+    with st.expander("📦 大文件流式匹配"):
+        st.caption("适用于数百万行的关键词导出文件：按块读取 CSV/Excel，使用上方的匹配设置逐块匹配后写入临时 CSV 文件再提供下载；不计算歧义词，也不输出全部品牌命中长表")
+        stream_file = st.file_uploader("上传关键词文件（格式同产品关键词文件：跳过前两行，需包含“关键词”列）", type=['csv', 'xlsx'], key='stream_upload')
+        stream_chunk_size = st.number_input("每块行数", min_value=10000, max_value=1000000, value=100000, step=10000)
+        if stream_file is not None and st.button("🚀 流式匹配并导出", use_container_width=True):
+            if st.session_state.brand_data is None:
+                st.error("❌ 请先上传品牌词数据文件")
+            else:
+                brand_df = st.session_state.brand_data
+                custom_rules_df = st.session_state.custom_rules
+                lexicon = get_brand_lexicon(
+                    match_options['engine'], cjk, variants, (), table_fingerprint(custom_rules_df),
+                    table_fingerprint(brand_df[lexicon_columns(brand_df)]), custom_rules_df, brand_df
+                )
+                # 先读出第一块检查列名，再与其余数据块一起逐块匹配
+                raw_chunks = read_keyword_chunks(stream_file, int(stream_chunk_size))
+                first_chunk = next(raw_chunks, None)
+                if first_chunk is None:
+                    st.error("❌ 文件中没有数据")
+                elif '关键词' not in first_chunk.columns:
+                    st.error("❌ 文件中缺少“关键词”列")
+                    st.info(f"📋 检测到的列名：{list(first_chunk.columns)}")
+                else:
+                    matched_chunks = match_keyword_chunks(
+                        itertools.chain([first_chunk], raw_chunks), lexicon,
+                        workers=match_options['workers'], resolve=match_options['resolve'],
+                        fuzzy=match_options['fuzzy'], collapse=collapse
+                    )
+                    # 结果逐块写入本会话的临时目录，文件名由程序生成；上一次的结果文件先删除
+                    previous = st.session_state.stream_result
+                    if previous is not None and os.path.exists(previous['path']):
+                        os.remove(previous['path'])
+                    output_dir = previous['dir'] if previous is not None else tempfile.mkdtemp(prefix='brand_match_')
+                    output_path = os.path.join(
+                        output_dir, f"品牌匹配结果_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv"
+                    )
+                    total_rows = branded_rows = 0
+                    try:
+                        with open(output_path, 'wb') as output, st.spinner("正在流式匹配..."):
+                            for number, chunk in enumerate(matched_chunks):
+                                # 只在文件开头写入表头和 BOM（Excel 按 UTF-8 打开中文 CSV 需要 BOM）
+                                encoding = 'utf-8-sig' if number == 0 else 'utf-8'
+                                chunk.to_csv(output, header=number == 0, index=False, encoding=encoding)
+                                total_rows += len(chunk)
+                                branded_rows += int((chunk['词性'] == 'Branded KWs').sum())
+                    except ValueError as e:
+                        # 中途失败（如正则规则超时）时丢弃已写出的部分结果
+                        os.remove(output_path)
+                        st.session_state.stream_result = None
+                        st.error(f"❌ 流式匹配失败：{e}")
+                    else:
+                        st.session_state.stream_result = {
+                            'dir': output_dir, 'path': output_path, 'rows': total_rows, 'branded': branded_rows,
+                        }
+        
+        stream_result = st.session_state.stream_result
+        if stream_result is not None and os.path.exists(stream_result['path']):
+            st.success(f"✅ 已匹配 {stream_result['rows']} 行，其中品牌词 {stream_result['branded']} 行")
+            # 点击下载时才从磁盘打开结果文件，匹配过程中不把结果读入内存
+            st.download_button(
+                label="下载流式匹配结果CSV文件",
+                data=partial(open, stream_result['path'], 'rb'),
+                file_name=os.path.basename(stream_result['path']),
+                mime="text/csv",
+                use_container_width=True
+            )
 
 with tab4:
     st.header("🔧 ASIN去重工具")
@@ -0,0 +1,1869 @@
+"""品牌匹配引擎
+
+关键词与品牌词的匹配统一采用整词匹配，边界规则与正则 ``(?<!\\w)…(?!\\w)`` 一致。
+各引擎接收按优先级排列的词条列表（手动规则在前，品牌词库在后），
+``match`` 返回命中词条中序号最小者，即与原逐条 ``re.search`` 相同的首个命中语义；
+``match_leftmost_longest`` 在同一层级内取最靠前、最长的命中，结果不受词库行顺序影响。
+两者都返回 (词条序号, 命中起始位置)，未命中为 (-1, -1)。
+"""
+import hashlib
+import multiprocessing
+import re
+import sys
+import threading
+import time
+import types
+import unicodedata
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+
+try:
+    from re import _compiler as sre_compile, _parser as sre_parse
+except ImportError:  # Python 3.10 及更早版本
+    import sre_compile
+    import sre_parse
+
+import numpy as np
+import pandas as pd
+
+
+def is_word_char(ch):
+    """判断字符是否属于正则中的 \\w（字母、数字、下划线）"""
+    return ch.isalnum() or ch == '_'
+
+
+def is_whole_word(text, start, end):
+    """判断 text[start:end] 两侧是否满足整词边界"""
+    if start > 0 and is_word_char(text[start - 1]):
+        return False
+    if end < len(text) and is_word_char(text[end]):
+        return False
+    return True
+
+
+# 中日韩文字的 Unicode 区段：韩文字母、假名、汉字、韩文音节及兼容汉字等
+_CJK_RANGES = (
+    (0x1100, 0x11FF), (0x3040, 0x30FF), (0x3130, 0x318F), (0x31F0, 0x31FF), (0x3400, 0x4DBF),
+    (0x4E00, 0x9FFF), (0xAC00, 0xD7AF), (0xF900, 0xFAFF), (0x20000, 0x2FA1F),
+)
+_CJK_CLASS = ''.join(f'{chr(low)}-{chr(high)}' for low, high in _CJK_RANGES)
+
+
+def is_cjk_char(ch):
+    """判断字符是否为中日韩文字"""
+    code = ord(ch)
+    return any(low <= code <= high for low, high in _CJK_RANGES)
+
+
+def is_script_boundary(text, start, end):
+    """按文字类型判断 text[start:end] 两侧的边界
+
+    只有当边界两侧都是非中日韩的单词字符时才视为词中间；中日韩文字之间没有空格，
+    因此与中日韩文字相邻的位置都视为边界，中文品牌可以在中文关键词中按子串命中。
+    """
+    if start > 0:
+        prev = text[start - 1]
+        if is_word_char(prev) and not is_cjk_char(prev) and not is_cjk_char(text[start]):
+            return False
+    if end < len(text):
+        nxt = text[end]
+        if is_word_char(nxt) and not is_cjk_char(nxt) and not is_cjk_char(text[end - 1]):
+            return False
+    return True
+
+
+# 分词：普通模式按 \w+ 切分；中日韩模式下每个中日韩字符单独成词，其余按连续单词字符切分
+_TOKEN_RE = re.compile(r'\w+')
+_CJK_TOKEN_RE = re.compile(f'[{_CJK_CLASS}]|[^\\W{_CJK_CLASS}]+')
+
+
+def token_pattern(cjk=False):
+    """返回与边界规则一致的分词正则"""
+    return _CJK_TOKEN_RE if cjk else _TOKEN_RE
+
+
+# 各类引号、破折号统一为 ASCII 形式（NFKC 不处理这些字符）
+_PUNCTUATION_TABLE = str.maketrans({
+    '\u2018': "'", '\u2019': "'", '\u201a': "'", '\u201b': "'", '\u2032': "'", '\u00b4': "'", '`': "'",
+    '\u201c': '"', '\u201d': '"', '\u201e': '"', '\u201f': '"', '\u2033': '"',
+    '\u2010': '-', '\u2011': '-', '\u2012': '-', '\u2013': '-', '\u2014': '-', '\u2015': '-', '\u2212': '-',
+})
+
+
+def _symbol_table():
+    """符号映射表：NFKC 会展开成字母或数字的符号（™、℠、Ⓡ、² 等）映射为空格
+
+    否则 "Anker™" 会变成 "ankertm"，品牌词后面多出字母而不再满足整词边界。
+    展开成汉字的符号（如康熙部首）保留；U+20000 以上只有汉字，不必检查。
+    """
+    table = {}
+    for code in range(0x20000):
+        ch = chr(code)
+        category = unicodedata.category(ch)
+        if category[0] != 'S' and category != 'No':
+            continue
+        expanded = unicodedata.normalize('NFKC', ch)
+        if expanded != ch and any(c.isalnum() and not is_cjk_char(c) for c in expanded):
+            table[code] = ' '
+    return table
+
+
+_SYMBOL_TABLE = _symbol_table()
+
+
+def normalize_series(values):
+    """关键词与品牌词共用的规范化流程（按列向量化执行，相同取值只处理一次）
+
+    依次执行：会展开成字母或数字的符号转空格、NFKC（全角转半角、兼容字符展开、NBSP 转空格）、casefold、去除重音符号、
+    统一引号和破折号、合并重复标点、合并连续空白并去除首尾空白。
+    """
+    values = pd.Series(values)
+    values = pd.Series([str(value) for value in values], index=values.index, dtype=object)
+    codes, uniques = pd.factorize(values)
+    # 使用 object 类型，保证 \w、\s 及反向引用按 Python re 的 Unicode 语义处理
+    normalized = (
+        pd.Series(uniques, dtype=object)
+        .str.translate(_SYMBOL_TABLE)
+        .str.normalize('NFKC')
+        .str.casefold()
+        .str.normalize('NFD')
+        .str.replace('[\u0300-\u036f]', '', regex=True)
+        .str.normalize('NFC')
+        .str.translate(_PUNCTUATION_TABLE)
+        .str.replace(r'([^\w\s])\1+', r'\1', regex=True)
+        .str.replace(r'\s+', ' ', regex=True)
+        .str.strip()
+    )
+    return pd.Series(normalized.to_numpy()[codes], index=values.index)
+
+
+def parse_priorities(df):
+    """读取表格的优先级列（数字越小越优先），没有该列或无法解析的值按 0 处理"""
+    if '优先级' not in df.columns:
+        return pd.Series(0.0, index=df.index)
+    return pd.to_numeric(df['优先级'], errors='coerce').fillna(0).astype(float)
+
+
+class BrandIndex:
+    """品牌词库索引：一次性编译规范化品牌词到原始品牌名称的映射
+
+    priorities 为每行品牌名称的优先级（数字越小越优先），品牌词按优先级稳定排序，
+    同一规范化品牌词取优先级最高的一行；未提供时按原顺序、优先级均为 0。
+    aliases 为每行品牌的别名（英文逗号分隔），别名作为品牌词编入索引并归属到该行品牌；
+    parents 为每行品牌的母公司，parents 属性记录 规范化品牌名 -> 母公司名称。
+    """
+
+    def __init__(self, brand_names, priorities=None, aliases=None, parents=None):
+        # 规范化品牌词 -> 首次出现的原始写法；collisions 记录规范化后重复的不同写法
+        self.canonical = {}
+        self.priorities = {}
+        self.collisions = {}
+        self.parents = {}
+        names = [str(name) for name in brand_names]
+        priorities = [0.0] * len(names) if priorities is None else [float(value) for value in priorities]
+        keys = list(normalize_series(names))
+        alias_lists = (
+            [[alias.strip() for alias in text.split(',')] for text in normalize_series(pd.Series(aliases).fillna(''))]
+            if aliases is not None else [[] for _ in names]
+        )
+        parents = list(parents) if parents is not None else [None] * len(names)
+        for row in sorted(range(len(names)), key=priorities.__getitem__):
+            name, key = names[row], keys[row]
+            if key not in self.canonical:
+                self.canonical[key] = name
+                self.priorities[key] = priorities[row]
+                if pd.notna(parents[row]) and str(parents[row]).strip():
+                    self.parents[key] = str(parents[row]).strip()
+            elif name != self.canonical[key]:
+                self.collisions.setdefault(key, [self.canonical[key]]).append(name)
+            # 别名归属到本行品牌；已被其他品牌或别名占用的不再覆盖
+            for alias in alias_lists[row]:
+                if alias and alias not in self.canonical:
+                    self.canonical[alias] = self.canonical[key]
+                    self.priorities[alias] = priorities[row]
+
+    def resolve(self, term):
+        """返回规范化品牌词对应的原始品牌名称"""
+        return self.canonical[term]
+
+
+def table_fingerprint(df):
+    """根据表格内容计算指纹，用于判断手动规则或品牌词库是否发生变化"""
+    hashes = pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy()
+    digest = hashlib.sha1('|'.join(map(str, df.columns)).encode('utf-8'))
+    digest.update(hashes.tobytes())
+    return digest.hexdigest()
+
+
+def _is_regex_rule(custom_rules_df):
+    """返回规则表每一行是否为正则规则；规则表没有规则类型列时全部视为关键词规则"""
+    if '规则类型' not in custom_rules_df.columns:
+        return pd.Series(False, index=custom_rules_df.index)
+    return custom_rules_df['规则类型'] == '正则'
+
+
+def _literal_rule_entries(custom_rules_df):
+    """逐个产出关键词规则的 (规范化匹配关键词, 归属品牌名, 优先级)
+
+    匹配关键词先整体规范化，全角逗号也会转换为英文逗号后再拆分。
+    """
+    custom_rules_df = custom_rules_df[~_is_regex_rule(custom_rules_df)]
+    keyword_lists = normalize_series(custom_rules_df['匹配关键词']) if len(custom_rules_df) else []
+    for brand_name, keywords, priority in zip(
+            custom_rules_df['品牌名称'], keyword_lists, parse_priorities(custom_rules_df)):
+        for kw in keywords.split(','):
+            kw = kw.strip()
+            if kw:
+                yield kw, str(brand_name), priority
+
+
+def _regex_rule_entries(custom_rules_df):
+    """逐个产出正则规则的 (正则表达式, 归属品牌名, 优先级)，表达式不拆分也不规范化"""
+    custom_rules_df = custom_rules_df[_is_regex_rule(custom_rules_df)]
+    for brand_name, pattern, priority in zip(
+            custom_rules_df['品牌名称'], custom_rules_df['匹配关键词'], parse_priorities(custom_rules_df)):
+        if pattern:
+            yield str(pattern), str(brand_name), priority
+
+
+def parse_manual_rules(custom_rules_df):
+    """解析手动规则表中的关键词规则，返回 规范化匹配关键词 -> 归属品牌名 的有序映射"""
+    return {kw: brand_name for kw, brand_name, _ in _literal_rule_entries(custom_rules_df)}
+
+
+def parse_regex_rules(custom_rules_df):
+    """解析手动规则表中的正则规则，返回 正则表达式 -> 归属品牌名 的有序映射"""
+    return {pattern: brand_name for pattern, brand_name, _ in _regex_rule_entries(custom_rules_df)}
+
+
+def parse_rule_priorities(custom_rules_df):
+    """解析手动规则表的优先级列，返回 匹配关键词或正则表达式 -> 优先级"""
+    priorities = {kw: priority for kw, _, priority in _literal_rule_entries(custom_rules_df)}
+    priorities.update((pattern, priority) for pattern, _, priority in _regex_rule_entries(custom_rules_df))
+    return priorities
+
+
+def _nested_repeat(parsed, repeated=False):
+    """判断正则语法树中是否有可多次重复的结构内部又嵌套了可变长度的重复（如 (a+)+、(\\w*)*）"""
+    for op, av in parsed:
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, high, body = av
+            if repeated and high > low and high > 1:
+                return True
+            if _nested_repeat(body, repeated or high > 1):
+                return True
+        elif op is sre_parse.SUBPATTERN:
+            if _nested_repeat(av[-1], repeated):
+                return True
+        elif op is sre_parse.BRANCH:
+            if any(_nested_repeat(branch, repeated) for branch in av[1]):
+                return True
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            if _nested_repeat(av[1], repeated):
+                return True
+    return False
+
+
+# 计算正则首字符集合时使用的字符样本：ASCII 及拉丁扩展字符，外加全角空格和常用汉字
+_FIRST_CHAR_SAMPLE = [chr(code) for code in range(0x250)] + list('\u3000的品牌安克')
+# 只匹配单个字符的正则语法节点
+_SINGLE_CHAR_OPS = (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.ANY, sre_parse.IN)
+_REPEAT_OPS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) + tuple(
+    getattr(sre_parse, name) for name in ('POSSESSIVE_REPEAT',) if hasattr(sre_parse, name)
+)
+_GROUP_OPS = (sre_parse.SUBPATTERN,) + tuple(
+    getattr(sre_parse, name) for name in ('ATOMIC_GROUP',) if hasattr(sre_parse, name)
+)
+
+
+def _first_chars(items, state):
+    """返回正则语法节点序列可能的首字符集合（在字符样本范围内）及该序列能否匹配空串"""
+    chars = set()
+    for op, av in items:
+        if op in _SINGLE_CHAR_OPS:
+            single = sre_compile.compile(sre_parse.SubPattern(state, [(op, av)]), re.IGNORECASE)
+            return chars | {ch for ch in _FIRST_CHAR_SAMPLE if single.fullmatch(ch)}, False
+        if op in _GROUP_OPS:
+            first, nullable = _first_chars(av[-1], state)
+        elif op is sre_parse.BRANCH:
+            branches = [_first_chars(branch, state) for branch in av[1]]
+            first = set().union(*(branch for branch, _ in branches))
+            nullable = any(branch_nullable for _, branch_nullable in branches)
+        elif op in _REPEAT_OPS:
+            first, nullable = _first_chars(av[2], state)
+            nullable = nullable or av[0] == 0
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            continue
+        else:
+            # 反向引用等无法静态确定，视为可以任意字符开头
+            return chars | set(_FIRST_CHAR_SAMPLE), False
+        chars |= first
+        if not nullable:
+            return chars, False
+    return chars, True
+
+
+def _overlapping_branch(items, follow, state):
+    """判断重复结构内部是否有首字符可能相同的分支（如 (a|aa)*），follow 为该序列之后可能出现的首字符
+
+    这类分支让同一段文本有多种切分方式，在不匹配的输入上回溯次数随长度指数增长。
+    能匹配空串的分支，其首字符还要算上分支之后的内容。
+    """
+    for index, (op, av) in enumerate(items):
+        rest, rest_nullable = _first_chars(items[index + 1:], state)
+        after = rest | follow if rest_nullable else rest
+        if op is sre_parse.BRANCH:
+            firsts = []
+            for branch in av[1]:
+                first, nullable = _first_chars(branch, state)
+                firsts.append(first | after if nullable else first)
+                if _overlapping_branch(branch, after, state):
+                    return True
+            if any(a & b for i, a in enumerate(firsts) for b in firsts[i + 1:]):
+                return True
+        elif op in _GROUP_OPS:
+            if _overlapping_branch(av[-1], after, state):
+                return True
+        elif op in _REPEAT_OPS:
+            if _overlapping_branch(av[2], _first_chars(av[2], state)[0] | after, state):
+                return True
+    return False
+
+
+def _ambiguous_repeat(parsed, state):
+    """判断正则语法树中可多次重复的结构内部是否有首字符可能相同的分支"""
+    for op, av in parsed:
+        if op in _REPEAT_OPS:
+            low, high, body = av
+            if high > 1 and _overlapping_branch(body, _first_chars(body, state)[0], state):
+                return True
+            if _ambiguous_repeat(body, state):
+                return True
+        elif op in _GROUP_OPS:
+            if _ambiguous_repeat(av[-1], state):
+                return True
+        elif op is sre_parse.BRANCH:
+            if any(_ambiguous_repeat(branch, state) for branch in av[1]):
+                return True
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            if _ambiguous_repeat(av[1], state):
+                return True
+    return False
+
+
+@lru_cache(maxsize=256)
+def compile_regex_rule(pattern):
+    """校验并编译正则规则（忽略大小写），语法错误、含有嵌套重复或重复内可重叠分支时抛出 ValueError
+
+    这两类结构在不匹配的输入上会产生指数级回溯，编译前静态拒绝；编译结果按表达式缓存。
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+        compiled = re.compile(pattern, re.IGNORECASE)
+    except re.error as exc:
+        raise ValueError(f"正则表达式有误：{exc}") from exc
+    if _nested_repeat(parsed):
+        raise ValueError("正则表达式含有嵌套的重复（如 (a+)+），可能导致灾难性回溯，请改写")
+    if _ambiguous_repeat(parsed, parsed.state):
+        raise ValueError("正则表达式的重复结构中含有可能重叠的分支（如 (a|aa)*），可能导致灾难性回溯，请改写")
+    return compiled
+
+
+def parse_exclusion_rules(custom_rules_df):
+    """解析手动规则表中的排除关键词，返回 规范化排除语境 -> 归属品牌名列表 的有序映射
+
+    同一排除语境可以属于多个品牌；规则表没有排除关键词列时返回空映射。
+    """
+    exclusions = {}
+    if '排除关键词' not in custom_rules_df.columns or not len(custom_rules_df):
+        return exclusions
+    phrase_lists = normalize_series(custom_rules_df['排除关键词'].fillna(''))
+    for brand_name, phrases in zip(custom_rules_df['品牌名称'], phrase_lists):
+        for phrase in phrases.split(','):
+            phrase = phrase.strip()
+            if phrase:
+                exclusions.setdefault(phrase, []).append(str(brand_name))
+    return exclusions
+
+
+class TermMatcher:
+    """匹配引擎基类：保存词条列表，序列化时只传递词条，由接收方重新构建
+
+    tiers 为每个词条所属的层级（如手动规则为 0、品牌词库为 1），最左最长模式下先比较层级；
+    cjk 为 True 时使用按文字类型区分的边界规则（见 is_script_boundary）。
+    """
+
+    def __init__(self, terms, tiers=None, cjk=False):
+        self.terms = list(terms)
+        self.tiers = list(tiers) if tiers is not None else [0] * len(self.terms)
+        self.cjk = cjk
+        self.boundary = is_script_boundary if cjk else is_whole_word
+        self.token_re = token_pattern(cjk)
+
+    def __reduce__(self):
+        return type(self), (self.terms, self.tiers, self.cjk)
+
+    def find_all(self, text):
+        """返回所有满足整词边界的命中 (起始位置, 结束位置, 词条序号)"""
+        raise NotImplementedError
+
+    def match(self, text):
+        """返回首个命中词条的 (序号, 该词条最靠前的起始位置)，未命中返回 (-1, -1)"""
+        best = None
+        for start, _, term_id in self.find_all(text):
+            if best is None or (term_id, start) < best:
+                best = (term_id, start)
+        return best if best is not None else (-1, -1)
+
+    def match_leftmost_longest(self, text):
+        """同一层级内取起始位置最靠前、其次长度最长的命中，结果与词条顺序无关，返回 (序号, 起始位置)"""
+        return self._leftmost_longest(self.find_all(text))
+
+    def _leftmost_longest(self, hits):
+        """从命中列表中按 (层级, 起始位置, -长度, 词条序号) 取最小者，返回 (序号, 起始位置)，没有命中返回 (-1, -1)"""
+        best = None
+        for start, end, term_id in hits:
+            key = (self.tiers[term_id], start, start - end, term_id)
+            if best is None or key < best:
+                best = key
+        return (best[3], best[1]) if best is not None else (-1, -1)
+
+
+class RegexLoopMatcher(TermMatcher):
+    """逐个词条执行正则整词匹配（原始实现，耗时随词库规模线性增长）"""
+
+    def __init__(self, terms, tiers=None, cjk=False):
+        super().__init__(terms, tiers, cjk)
+        # 重复词条只保留序号最小的一个
+        first_ids = _first_ids(terms)
+        # 中日韩模式下边界无法用 \w 环视表达，先找出全部出现位置再逐个检查边界
+        template = r'(?=({}))' if cjk else r'(?<!\w)(?=({})(?!\w))'
+        self.patterns = [
+            (term_id, re.compile(template.format(re.escape(term)), re.IGNORECASE))
+            for term, term_id in first_ids.items()
+        ]
+
+    def find_all(self, text):
+        """返回所有满足整词边界的命中 (起始位置, 结束位置, 词条序号)"""
+        hits = []
+        for term_id, pattern in self.patterns:
+            # 用零宽前瞻找出重叠的全部命中
+            for hit in pattern.finditer(text):
+                start, end = hit.span(1)
+                if self.boundary(text, start, end):
+                    hits.append((start, end, term_id))
+        return hits
+
+    def match(self, text):
+        """返回首个命中词条的 (序号, 起始位置)，未命中返回 (-1, -1)"""
+        for term_id, pattern in self.patterns:
+            for hit in pattern.finditer(text):
+                if self.boundary(text, *hit.span(1)):
+                    return term_id, hit.start(1)
+        return -1, -1
+
+
+class AhoCorasickMatcher(TermMatcher):
+    """Aho-Corasick 多模式自动机：每个关键词只扫描一遍，耗时与关键词长度相关"""
+
+    def __init__(self, terms, tiers=None, cjk=False):
+        super().__init__(terms, tiers, cjk)
+        # goto[node] 为字符转移表，output[node] 为在该节点结束的 (词条序号, 词条长度)
+        self.goto = [{}]
+        self.fail = [0]
+        output = [[]]
+        for term_id, term in enumerate(terms):
+            if not term:
+                continue
+            node = 0
+            for ch in term:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    output.append([])
+                node = nxt
+            # 重复词条只保留序号最小的一个
+            if not output[node]:
+                output[node].append((term_id, len(term)))
+
+        # 广度优先构建失败指针，并合并后缀节点的输出
+        queue = list(self.goto[0].values())
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                state = self.fail[node]
+                while state and ch not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[nxt] = self.goto[state].get(ch, 0)
+                output[nxt].extend(output[self.fail[nxt]])
+        self.output = [tuple(items) for items in output]
+
+    def scan(self, text):
+        """逐个产出词条在 text 中的全部出现 (起始位置, 结束位置, 词条序号)，不检查边界"""
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        for pos, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for term_id, length in output[node]:
+                yield pos + 1 - length, pos + 1, term_id
+
+    def find_all(self, text):
+        """返回所有满足整词边界的命中 (起始位置, 结束位置, 词条序号)"""
+        boundary = self.boundary
+        return [hit for hit in self.scan(text) if boundary(text, hit[0], hit[1])]
+
+
+_TRIE_END = ''
+
+
+def _trie_to_regex(node):
+    """将前缀树递归展开为因式分解后的正则表达式，叶子节点返回 None"""
+    alternatives = []
+    chars = []
+    for ch, child in node.items():
+        if ch == _TRIE_END:
+            continue
+        sub = _trie_to_regex(child)
+        if sub is None:
+            chars.append(re.escape(ch))
+        else:
+            alternatives.append(re.escape(ch) + sub)
+    if not alternatives and not chars:
+        return None
+
+    # 只由单字符组成时结果本身是一个原子，可直接加量词
+    atom = not alternatives
+    if chars:
+        alternatives.append(chars[0] if len(chars) == 1 else '[' + ''.join(chars) + ']')
+    if len(alternatives) > 1:
+        result = '(?:' + '|'.join(alternatives) + ')'
+        atom = True
+    else:
+        result = alternatives[0]
+    if _TRIE_END in node:
+        result = (result if atom else '(?:' + result + ')') + '?'
+    return result
+
+
+class TrieRegexMatcher(TermMatcher):
+    """将整个词库按前缀树因式分解为单个正则，每个关键词只执行一次正则扫描"""
+
+    def __init__(self, terms, tiers=None, cjk=False):
+        super().__init__(terms, tiers, cjk)
+        # 前缀树：字符 -> 子节点，_TRIE_END 键记录在此结束的词条序号（重复词条保留最小序号）
+        self.trie = {}
+        for term_id, term in enumerate(terms):
+            if not term:
+                continue
+            node = self.trie
+            for ch in term:
+                node = node.setdefault(ch, {})
+            node.setdefault(_TRIE_END, term_id)
+
+        body = _trie_to_regex(self.trie)
+        # 零宽前瞻定位所有可能的命中起点，命中词条及边界再由前缀树确定（中日韩模式下不在正则中限定边界）
+        template = '(?={})' if cjk else r'(?<!\w)(?={}(?!\w))'
+        self.locator = re.compile(template.format(body)) if body else None
+
+    def find_all(self, text):
+        """返回所有满足整词边界的命中 (起始位置, 结束位置, 词条序号)"""
+        hits = []
+        if self.locator is None:
+            return hits
+        for located in self.locator.finditer(text):
+            start = located.start()
+            node = self.trie
+            for pos in range(start, len(text)):
+                node = node.get(text[pos])
+                if node is None:
+                    break
+                if _TRIE_END in node and self.boundary(text, start, pos + 1):
+                    hits.append((start, pos + 1, node[_TRIE_END]))
+        return hits
+
+    def match(self, text):
+        """返回首个命中词条的 (序号, 起始位置)，未命中返回 (-1, -1)"""
+        if self.locator is None or not self.locator.search(text):
+            return -1, -1
+        return super().match(text)
+
+
+class NgramMatcher(TermMatcher):
+    """关键词分词一次后，用 1..k 元词组查哈希表，单个关键词耗时为 O(词数 × k)
+
+    整词命中的词条必然从某个词的开头开始、在某个词的结尾结束，因此首尾均为单词字符的词条
+    都可以通过词组切片直接查表；首尾带符号的少量词条（如 "+plus"）交给一个小型自动机处理。
+    中日韩模式下每个中日韩字符单独成词，与 is_script_boundary 的边界规则一致。
+    """
+
+    def __init__(self, terms, tiers=None, cjk=False):
+        super().__init__(terms, tiers, cjk)
+        self.phrases = {}
+        self.max_tokens = 0
+        residual_terms = []
+        self.residual_ids = []
+        for term_id, term in enumerate(terms):
+            if not term:
+                continue
+            if is_word_char(term[0]) and is_word_char(term[-1]):
+                self.phrases.setdefault(term, term_id)
+                self.max_tokens = max(self.max_tokens, len(self.token_re.findall(term)))
+            else:
+                residual_terms.append(term)
+                self.residual_ids.append(term_id)
+        self.residual = AhoCorasickMatcher(residual_terms, cjk=cjk) if residual_terms else None
+
+    def find_all(self, text):
+        """返回所有满足整词边界的命中 (起始位置, 结束位置, 词条序号)"""
+        hits = []
+        phrases = self.phrases
+        spans = [token.span() for token in self.token_re.finditer(text)]
+        for i, (start, _) in enumerate(spans):
+            for j in range(i, min(len(spans), i + self.max_tokens)):
+                end = spans[j][1]
+                term_id = phrases.get(text[start:end])
+                if term_id is not None:
+                    hits.append((start, end, term_id))
+        if self.residual is not None:
+            hits.extend(
+                (start, end, self.residual_ids[term_id])
+                for start, end, term_id in self.residual.find_all(text)
+            )
+        return hits
+
+
+# 折叠匹配时忽略的分隔符
+_SEPARATORS = frozenset(' -')
+
+
+def collapse_separators(text):
+    """去掉空格和连字符，返回 (折叠后的文本, 折叠文本中每个字符在原文中的位置)"""
+    offsets = [pos for pos, ch in enumerate(text) if ch not in _SEPARATORS]
+    return ''.join(text[pos] for pos in offsets), offsets
+
+
+class CollapsedMatcher(TermMatcher):
+    """分隔符折叠索引："sound core"、"sound-core" 与 "soundcore" 视为同一个词
+
+    词条去掉空格和连字符后建一个 Aho-Corasick 自动机；关键词同样折叠后扫描一遍，
+    命中通过位置映射换算回原文中的起止位置，再按原文检查整词边界。
+    """
+
+    def __init__(self, terms, tiers=None, cjk=False):
+        super().__init__(terms, tiers, cjk)
+        self.automaton = AhoCorasickMatcher([collapse_separators(term)[0] for term in self.terms], cjk=cjk)
+
+    def find_all(self, text):
+        """返回所有折叠后命中且在原文中满足整词边界的命中 (起始位置, 结束位置, 词条序号)"""
+        collapsed, offsets = collapse_separators(text)
+        hits = []
+        for start, end, term_id in self.automaton.scan(collapsed):
+            start, end = offsets[start], offsets[end - 1] + 1
+            if self.boundary(text, start, end):
+                hits.append((start, end, term_id))
+        return hits
+
+
+class CompetingCollapsedMatcher(TermMatcher):
+    """精确命中与折叠命中放在一起按最左最长选择，如 "sound core" 中折叠的 soundcore 胜过精确的 sound
+
+    折叠命中的词条序号加上词条数返回，调用方据此区分两种命中；起止位置相同时精确命中优先。
+    """
+
+    def __init__(self, matcher, collapsed):
+        super().__init__(matcher.terms, matcher.tiers * 2, matcher.cjk)
+        self.matcher = matcher
+        self.collapsed = collapsed
+
+    def __reduce__(self):
+        return type(self), (self.matcher, self.collapsed)
+
+    def find_all(self, text):
+        """返回精确命中及序号偏移后的折叠命中 (起始位置, 结束位置, 词条序号)"""
+        size = len(self.terms)
+        return self.matcher.find_all(text) + [
+            (start, end, term_id + size) for start, end, term_id in self.collapsed.find_all(text)
+        ]
+
+
+_main_lock = threading.Lock()
+
+
+@contextmanager
+def _spawn_without_main():
+    """在此期间启动的 spawn 子进程不导入主模块
+
+    spawn 子进程默认按 __main__ 的 __file__ 重新执行主脚本；在 streamlit run 下 __main__ 是指向 app.py 的伪模块，
+    子进程会把整个页面再执行一遍。启动期间临时换成空模块，结束后若未被其他线程替换则恢复。
+    """
+    with _main_lock:
+        main = sys.modules.get('__main__')
+        placeholder = types.ModuleType('__main__')
+        sys.modules['__main__'] = placeholder
+        try:
+            yield
+        finally:
+            if sys.modules.get('__main__') is placeholder:
+                sys.modules['__main__'] = main
+
+
+def _regex_rule_worker(connection, progress):
+    """子进程：循环接收 (正则列表, 关键词列表)，逐条规则扫描全部关键词，每条执行完后发送 (规则下标, 命中列表)
+
+    命中为 (关键词下标, 起始位置, 结束位置)。progress 记录本批已开始的搜索次数，供主进程计时；
+    发送结果期间置为 -1。收到 None 时退出。
+    """
+    for patterns, keywords in iter(connection.recv, None):
+        for index, pattern in enumerate(patterns):
+            compiled = compile_regex_rule(pattern)
+            offset = index * len(keywords)
+            spans = []
+            for pos, text in enumerate(keywords):
+                progress.value = offset + pos + 1
+                spans.extend(
+                    (pos, hit.start(), hit.end()) for hit in compiled.finditer(text) if hit.end() > hit.start()
+                )
+            progress.value = -1
+            connection.send((index, spans))
+    connection.close()
+
+
+class RegexRuleRunner:
+    """在常驻子进程中执行一组正则规则，超时的规则终止子进程后整条放弃
+
+    Python 的正则在同一进程中无法中途打断，因此放到子进程中执行，主进程按搜索进度计时：
+    单次搜索超过 max_seconds 秒，或一条规则在整批关键词上累计超过 max_seconds + max_mean × 关键词数秒，
+    都判定为超时。子进程在多次 run 之间复用（如流式匹配的各个数据块），超时后才重新启动。
+    """
+
+    def __init__(self, patterns, max_seconds=0.2, max_mean=1e-4):
+        self.patterns = list(patterns)
+        self.max_seconds = max_seconds
+        self.max_mean = max_mean
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _start(self):
+        """启动子进程，返回 (进程, 连接, 进度计数)"""
+        progress = self.context.Value('q', 0, lock=False)
+        connection, child_connection = self.context.Pipe()
+        process = self.context.Process(target=_regex_rule_worker, args=(child_connection, progress), daemon=True)
+        with _spawn_without_main():
+            process.start()
+        child_connection.close()
+        self.process = process, connection, progress
+        return self.process
+
+    def _stop(self, kill=False):
+        """停止子进程；kill 为 False 时先通知其正常退出"""
+        if self.process is None:
+            return
+        process, connection, _ = self.process
+        self.process = None
+        if not kill and process.is_alive():
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            process.join(1)
+        if process.is_alive():
+            process.kill()
+        process.join()
+        connection.close()
+
+    def close(self):
+        """结束子进程"""
+        self._stop()
+
+    def run(self, keywords):
+        """用每条正则扫描一批关键词，返回 (每条规则的命中列表, 超时规则的下标列表)
+
+        命中为 (关键词下标, 起始位置, 结束位置)，超时规则的命中为 None；子进程从下一条规则继续。
+        """
+        keywords = list(keywords)
+        results = [None] * len(self.patterns)
+        exhausted = []
+        if not keywords:
+            return [[] for _ in self.patterns], exhausted
+        interval = min(0.05, self.max_seconds / 4)
+        budget = self.max_seconds + self.max_mean * len(keywords)
+        first = 0
+        while first < len(self.patterns):
+            process, connection, progress = self.process or self._start()
+            progress.value = 0
+            connection.send((self.patterns[first:], keywords))
+            # 子进程启动（导入模块）期间进度为 0，开始第一次搜索后才计时
+            seen, changed_at, rule, rule_started = 0, None, None, None
+            timed_out, done = None, first
+            while done < len(self.patterns):
+                if connection.poll(interval):
+                    try:
+                        index, spans = connection.recv()
+                    except EOFError:
+                        break
+                    results[first + index] = spans
+                    done = first + index + 1
+                    continue
+                value, now = progress.value, time.perf_counter()
+                if value <= 0:
+                    seen = value
+                elif value != seen:
+                    seen, changed_at = value, now
+                    if (value - 1) // len(keywords) != rule:
+                        rule, rule_started = (value - 1) // len(keywords), now
+                elif now - changed_at > self.max_seconds:
+                    timed_out = first + rule
+                    break
+                if value > 0 and now - rule_started > budget:
+                    timed_out = first + rule
+                    break
+                if not process.is_alive() and not connection.poll():
+                    break
+            if timed_out is None:
+                if done < len(self.patterns):
+                    self._stop(kill=True)
+                    raise RuntimeError("正则规则子进程异常退出")
+                break
+            self._stop(kill=True)
+            exhausted.append(timed_out)
+            first = timed_out + 1
+        return results, exhausted
+
+
+class RegexRuleMatcher(TermMatcher):
+    """正则规则：字面词条交给内层引擎一次扫描，只有正则规则逐条对关键词执行
+
+    rules 为 (词条序号, 正则表达式) 列表，内层引擎中对应序号的词条为空。
+    批量匹配前先用 prepare 在子进程中带超时执行全部正则规则（见 RegexRuleRunner），
+    得到的匹配器按 hits（关键词 -> 正则命中）查表，超时的规则在整批关键词上都不使用。
+    hits 为 None 时直接在当前进程执行正则，不做超时保护。
+    """
+
+    def __init__(self, matcher, rules, max_seconds=0.2, hits=None):
+        super().__init__(matcher.terms, matcher.tiers, matcher.cjk)
+        self.matcher = matcher
+        self.rules = sorted(rules)
+        self.max_seconds = max_seconds
+        self.hits = hits
+        self.patterns = [(term_id, compile_regex_rule(pattern)) for term_id, pattern in self.rules]
+
+    def __reduce__(self):
+        return type(self), (self.matcher, self.rules, self.max_seconds, self.hits)
+
+    def runner(self):
+        """返回执行本组正则规则的子进程执行器，可在多批关键词之间复用"""
+        return RegexRuleRunner([pattern for _, pattern in self.rules], self.max_seconds)
+
+    def prepare(self, keywords, runner=None):
+        """对一批关键词执行全部正则规则，返回 (查表用的匹配器, 超时停用的词条序号列表)
+
+        每次调用都重新执行，停用的规则只对本批关键词有效。runner 为 None 时临时启动一个执行器。
+        """
+        keywords = list(keywords)
+        if runner is None:
+            with self.runner() as runner:
+                spans, exhausted = runner.run(keywords)
+        else:
+            spans, exhausted = runner.run(keywords)
+        hits = {}
+        for (term_id, _), rule_spans in zip(self.rules, spans):
+            for pos, start, end in rule_spans or ():
+                text = keywords[pos]
+                if self.boundary(text, start, end):
+                    hits.setdefault(text, []).append((start, end, term_id))
+        rules = [rule for rule, rule_spans in zip(self.rules, spans) if rule_spans is not None]
+        return type(self)(self.matcher, rules, self.max_seconds, hits), [self.rules[i][0] for i in exhausted]
+
+    def _search(self, index, text):
+        """执行第 index 条正则，返回满足边界的命中"""
+        term_id, pattern = self.patterns[index]
+        return [
+            (hit.start(), hit.end(), term_id) for hit in pattern.finditer(text)
+            if hit.end() > hit.start() and self.boundary(text, hit.start(), hit.end())
+        ]
+
+    def _rule_hits(self, text):
+        """返回所有正则规则的命中"""
+        if self.hits is not None:
+            return self.hits.get(text, [])
+        return [hit for index in range(len(self.patterns)) for hit in self._search(index, text)]
+
+    def find_all(self, text):
+        """返回内层引擎与正则规则的全部命中 (起始位置, 结束位置, 词条序号)"""
+        return self.matcher.find_all(text) + self._rule_hits(text)
+
+    def match(self, text):
+        """返回首个命中词条的 (序号, 起始位置)：只需执行序号小于内层引擎结果的正则规则"""
+        best = self.matcher.match(text)
+        if self.hits is not None:
+            rule_hits = [(term_id, start) for start, _, term_id in self.hits.get(text, ())]
+            first = min(rule_hits, default=None)
+            return first if first is not None and not 0 <= best[0] < first[0] else best
+        for index, (term_id, _) in enumerate(self.patterns):
+            if 0 <= best[0] < term_id:
+                break
+            hits = self._search(index, text)
+            if hits:
+                return term_id, hits[0][0]
+        return best
+
+    def match_leftmost_longest(self, text):
+        """正则规则没有命中时直接取内层引擎的结果"""
+        hits = self._rule_hits(text)
+        if not hits:
+            return self.matcher.match_leftmost_longest(text)
+        return self._leftmost_longest(self.matcher.find_all(text) + hits)
+
+
+class ExclusionMatcher(TermMatcher):
+    """排除语境过滤：命中位于同一品牌的排除语境之内时作废（如 "apple cider" 中的 "apple"）
+
+    排除语境作为普通词条排在词表末尾，与品牌词条编进同一个匹配引擎；只有选出的命中所属品牌
+    设有排除语境时才需要取出全部命中逐个检查，其余关键词的开销与不设排除语境时相同。
+    guards 为每个词条受排除语境约束的品牌键（不受约束为 None），vetoes 为 排除语境词条序号 -> 品牌键元组。
+    """
+
+    def __init__(self, matcher, guards, vetoes):
+        super().__init__(matcher.terms, matcher.tiers, matcher.cjk)
+        self.matcher = matcher
+        self.guards = guards
+        self.vetoes = vetoes
+
+    def __reduce__(self):
+        return type(self), (self.matcher, self.guards, self.vetoes)
+
+    def find_all(self, text):
+        """返回所有未被排除语境覆盖的命中 (起始位置, 结束位置, 词条序号)"""
+        hits = self.matcher.find_all(text)
+        vetoes = [(start, end, self.vetoes[term_id]) for start, end, term_id in hits if term_id in self.vetoes]
+        if not vetoes:
+            return hits
+        return [
+            (start, end, term_id) for start, end, term_id in hits
+            if term_id not in self.vetoes and not any(
+                self.guards[term_id] in keys and veto_start <= start and end <= veto_end
+                for veto_start, veto_end, keys in vetoes
+            )
+        ]
+
+    def _resolve(self, method, text):
+        """先由内层引擎选出命中，只有命中受排除语境约束时才按过滤后的全部命中重新选择"""
+        term_id, start = getattr(self.matcher, method)(text)
+        if term_id in self.vetoes:
+            # 排除语境排在最后，被选中说明没有任何品牌命中
+            return -1, -1
+        if term_id < 0 or self.guards[term_id] is None:
+            return term_id, start
+        return getattr(TermMatcher, method)(self, text)
+
+    def match(self, text):
+        """返回首个未被排除的命中词条的 (序号, 起始位置)，未命中返回 (-1, -1)"""
+        return self._resolve('match', text)
+
+    def match_leftmost_longest(self, text):
+        """同 TermMatcher.match_leftmost_longest，只考虑未被排除的命中"""
+        return self._resolve('match_leftmost_longest', text)
+
+
+def _deletes(word, distance):
+    """生成删除至多 distance 个字符后得到的所有字符串（含原词）"""
+    result = {word}
+    frontier = {word}
+    for _ in range(distance):
+        frontier = {variant[:i] + variant[i + 1:] for variant in frontier for i in range(len(variant))}
+        result |= frontier
+    return result
+
+
+def edit_distance(a, b, limit):
+    """计算限制编辑距离（含相邻字符交换），超过 limit 时返回 limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+
+class FuzzyMatcher(TermMatcher):
+    """SymSpell 式删除邻域索引：关键词中的单个整词与单词品牌词条在容错距离内视为命中
+
+    只收录由单个整词构成、长度不少于 min_length 的词条；允许的编辑距离随词长增加，
+    4～7 个字符允许 1 处错误，8 个字符以上允许 2 处，且不超过 max_distance。
+    查询时只生成关键词整词自身的删除邻域并查表，不与每个品牌逐一比较。
+    """
+
+    def __init__(self, terms, tiers=None, max_distance=2, min_length=4, cjk=False):
+        super().__init__(terms, tiers, cjk)
+        self.max_distance = max_distance
+        self.min_length = min_length
+        # 删除后的字符串 -> 词条序号列表
+        self.deletes = {}
+        for term, term_id in _first_ids(self.terms).items():
+            distance = self.allowed_distance(term)
+            if distance and self.token_re.fullmatch(term):
+                for variant in _deletes(term, distance):
+                    self.deletes.setdefault(variant, []).append(term_id)
+
+    def __reduce__(self):
+        return type(self), (self.terms, self.tiers, self.max_distance, self.min_length, self.cjk)
+
+    def allowed_distance(self, word):
+        """返回某个词允许的最大编辑距离"""
+        if len(word) < self.min_length:
+            return 0
+        return min(self.max_distance, 1 if len(word) < 8 else 2)
+
+    def lookup(self, token):
+        """返回与整词在容错距离内（不含完全相同）的 (编辑距离, 词条序号) 列表"""
+        distance = self.allowed_distance(token)
+        if not distance:
+            return []
+        candidates = set()
+        for variant in _deletes(token, distance):
+            candidates.update(self.deletes.get(variant, ()))
+        found = []
+        for term_id in candidates:
+            term = self.terms[term_id]
+            limit = min(distance, self.allowed_distance(term))
+            dist = edit_distance(token, term, limit)
+            if 0 < dist <= limit:
+                found.append((dist, term_id))
+        return found
+
+    def find_all(self, text):
+        """返回所有模糊命中 (起始位置, 结束位置, 词条序号)"""
+        return [
+            (token.start(), token.end(), term_id)
+            for token in self.token_re.finditer(text)
+            for _, term_id in self.lookup(token.group())
+        ]
+
+    def match(self, text):
+        """按 (编辑距离, 层级, 起始位置, 词条序号) 取最优的模糊命中，返回 (序号, 起始位置)，未命中返回 (-1, -1)"""
+        best = None
+        for token in self.token_re.finditer(text):
+            for dist, term_id in self.lookup(token.group()):
+                key = (dist, self.tiers[term_id], token.start(), term_id)
+                if best is None or key < best:
+                    best = key
+        return (best[3], best[2]) if best is not None else (-1, -1)
+
+    match_leftmost_longest = match
+
+
+# 可选匹配引擎
+MATCH_ENGINES = {
+    'aho': AhoCorasickMatcher,
+    'trie_regex': TrieRegexMatcher,
+    'ngram': NgramMatcher,
+    'regex': RegexLoopMatcher,
+}
+
+
+# 命中选择方式 -> 匹配器方法名：priority 按词条顺序取首个命中，leftmost_longest 取最左最长命中
+RESOLVE_METHODS = {
+    'priority': 'match',
+    'leftmost_longest': 'match_leftmost_longest',
+}
+
+
+def build_matcher(terms, engine='aho', tiers=None, cjk=False):
+    """根据引擎名称构建匹配器"""
+    if engine not in MATCH_ENGINES:
+        raise ValueError(f"未知的匹配引擎：{engine}")
+    return MATCH_ENGINES[engine](terms, tiers, cjk)
+
+
+def plural_variants(term, min_length=3):
+    """生成词条的英文复数变体：以 s/x/z/ch/sh 结尾的加 es，其余以字母结尾的加 s
+
+    所有格（anker's）和连字符后缀（anker-branded）中的撇号、连字符本身就是整词边界，
+    原词条已能命中，无需生成变体。
+    """
+    if len(term) < min_length or not 'a' <= term[-1] <= 'z':
+        return []
+    if term.endswith(('s', 'x', 'z', 'ch', 'sh')):
+        return [term + 'es']
+    return [term + 's']
+
+
+class TokenFilter:
+    """品牌词整词的哈希位图（单哈希函数的 Bloom 过滤器），用于在匹配前整列筛掉不含品牌词的关键词
+
+    词条整词命中时，其包含的每个整词也必然是关键词中的整词；关键词中没有任何整词落在位图中时不可能有精确命中，
+    可以直接判定为未命中，只把其余关键词交给匹配引擎。位图只有假阳性（多交给引擎匹配），没有假阴性。
+    每个整词占 bits_per_token 位，假阳性率约为 1 / bits_per_token。
+    """
+
+    def __init__(self, terms, cjk=False, bits_per_token=16):
+        self.token_re = token_pattern(cjk)
+        tokens = pd.unique(pd.Series([token for term in terms for token in self.token_re.findall(term)], dtype=object))
+        size = 1 << max(6, int(np.ceil(np.log2(max(len(tokens), 1) * bits_per_token))))
+        self.mask = np.uint64(size - 1)
+        bits = np.zeros(size, dtype=bool)
+        bits[self._slots(tokens)] = True
+        self.bits = np.packbits(bits, bitorder='little')
+
+    def _slots(self, tokens):
+        """整词在位图中的位置"""
+        return (pd.util.hash_array(np.asarray(tokens, dtype=object)) & self.mask).astype(np.int64)
+
+    def candidates(self, keywords):
+        """返回可能有精确命中的关键词下标（即至少有一个整词落在位图中的关键词）"""
+        tokens = pd.Series(np.asarray(keywords, dtype=object)).str.findall(self.token_re).explode().dropna()
+        slots = self._slots(tokens.to_numpy())
+        hit = (self.bits[slots >> 3] >> (slots & 7)) & 1
+        return np.unique(tokens.index.to_numpy()[hit.astype(bool)])
+
+
+# 置信度特征：各类型词条命中的基础分（手动关键词规则为用户明确指定，取 1.0）
+KIND_CONFIDENCE = {'manual': 1.0, 'exact': 0.9, 'regex': 0.9, 'variant': 0.75, 'exclusion': 0.0}
+# 歧义得分达到该比例时置信度折半，低于该比例时按比例折扣
+AMBIGUITY_SCALE = 0.2
+
+
+class BrandLexicon:
+    """编译后的匹配词表：词条按 (是否降级, 优先级, 来源, 原顺序) 排列，序号越小优先级越高
+
+    数字越小的优先级越优先，相同优先级时手动规则（关键词规则、正则规则）先于品牌词库。
+    """
+
+    def __init__(self, manual_map, brand_index, engine='aho', cjk=False, variants=False, exclusions=None,
+                 regex_rules=None, priorities=None, demoted=None):
+        # priorities 为手动规则的优先级（见 parse_rule_priorities），品牌词库的优先级取自 brand_index；
+        # regex_rules（见 parse_regex_rules）排在关键词规则之后、品牌词库之前；
+        # demoted 为降级的品牌词库词条（如歧义过高的通用词），排在所有未降级的原词条之后
+        priorities = priorities or {}
+        regex_rules = regex_rules or {}
+        demoted = set(demoted or ())
+        # (是否降级, 优先级, 来源, 原顺序, 词条, 归属品牌, 类型)
+        entries = [(False, priorities.get(term, 0.0), 0, term, brand, 'exact') for term, brand in manual_map.items()]
+        entries += [
+            (False, priorities.get(pattern, 0.0), 0, pattern, brand, 'regex') for pattern, brand in regex_rules.items()
+        ]
+        entries += [
+            (term in demoted, brand_index.priorities.get(term, 0.0), 1, term, brand_index.resolve(term), 'exact')
+            for term in brand_index.canonical
+        ]
+        entries = sorted(
+            (demote, priority, source, order, term, brand, kind)
+            for order, (demote, priority, source, term, brand, kind) in enumerate(entries)
+        )
+        self.terms = [entry[4] for entry in entries]
+        # 归属品牌：手动规则取规则品牌，品牌词库取原始品牌名称
+        self.brands = [entry[5] for entry in entries]
+        # exact 为原词条，regex 为正则规则，variant 为编译时生成的变体，exclusion 为排除语境
+        self.kinds = [entry[6] for entry in entries]
+        self.priorities = [entry[1] for entry in entries]
+        # 0 为手动规则，1 为品牌词库，排除语境为 None
+        self.sources = [entry[2] for entry in entries]
+        # 按优先级换算为层级，引擎取序号最小或层级最高的命中即可一次选出结果；
+        # levels 为层级的来源键，不随词表中其他词条变化，供增量匹配比较
+        levels = {level: tier for tier, level in enumerate(sorted({entry[:3] for entry in entries}))}
+        self.tiers = [levels[entry[:3]] for entry in entries]
+        self.levels = [entry[:3] for entry in entries]
+        self.exact_count = len(self.terms)
+        self.exact_tiers = len(levels)
+        # 复数变体追加在原词条之后、层级排在所有原词条之后
+        if variants:
+            self._add_variants()
+        # 每个词条受约束的规范化品牌名；排除语境（见 parse_exclusion_rules）追加在词表末尾、层级最低，
+        # 记录其归属品牌名元组
+        self.veto_keys = [None] * len(self.terms)
+        if exclusions:
+            self._add_exclusions(exclusions)
+        # parent_codes 为每个词条所属母公司的整数编码（排除语境为 -1），parent_names 为编码对应的名称
+        self._compile_parents(brand_index)
+        # 为 True 时使用按文字类型区分的边界规则
+        self.cjk = cjk
+        # 字面词条编入同一个引擎（正则规则位置为空），正则规则由 RegexRuleMatcher 逐条执行
+        self.literals = [term if kind != 'regex' else '' for term, kind in zip(self.terms, self.kinds)]
+        matcher = build_matcher(self.literals, engine, self.tiers, cjk)
+        rules = [(term_id, term) for term_id, (term, kind) in enumerate(zip(self.terms, self.kinds)) if kind == 'regex']
+        self.regex_matcher = RegexRuleMatcher(matcher, rules) if rules else None
+        self.matcher = self._guard(self.regex_matcher or matcher)
+        self.token_filter = self._build_token_filter()
+        self._collapsed_matcher = None
+        self._fuzzy_matchers = {}
+
+    def _add_variants(self):
+        """把原词条的复数变体追加到词表末尾，已存在的词条不重复添加"""
+        known = set(self.terms)
+        for term_id in range(self.exact_count):
+            if self.kinds[term_id] == 'regex':
+                continue
+            for variant in plural_variants(self.terms[term_id]):
+                if variant not in known:
+                    known.add(variant)
+                    self.terms.append(variant)
+                    self.brands.append(self.brands[term_id])
+                    self.tiers.append(self.exact_tiers)
+                    self.levels.append('variant')
+                    self.priorities.append(self.priorities[term_id])
+                    self.sources.append(self.sources[term_id])
+                    self.kinds.append('variant')
+
+    def _add_exclusions(self, exclusions):
+        """把排除语境追加到词表末尾，只保留归属品牌在词表中出现过、且不与品牌词条重复的排除语境"""
+        brand_keys = list(normalize_series(self.brands))
+        known_keys = set(brand_keys)
+        known_terms = set(self.terms)
+        guarded = set()
+        for phrase, owners in exclusions.items():
+            keys = tuple(sorted(set(normalize_series(owners)) & known_keys))
+            if not keys or phrase in known_terms:
+                continue
+            self.terms.append(phrase)
+            self.brands.append(None)
+            self.tiers.append(self.exact_tiers + 1)
+            self.levels.append('exclusion')
+            self.priorities.append(None)
+            self.sources.append(None)
+            self.kinds.append('exclusion')
+            self.veto_keys.append(keys)
+            guarded.update(keys)
+        for term_id, key in enumerate(brand_keys):
+            if key in guarded:
+                self.veto_keys[term_id] = key
+
+    def _compile_parents(self, brand_index):
+        """预先计算每个词条的母公司编码，没有登记母公司的品牌以自身为母公司"""
+        brand_keys = normalize_series(['' if brand is None else brand for brand in self.brands])
+        parents = [
+            None if brand is None else brand_index.parents.get(key, brand)
+            for brand, key in zip(self.brands, brand_keys)
+        ]
+        codes, names = pd.factorize(pd.Series(parents, dtype=object))
+        self.parent_codes = codes.astype(np.int64)
+        self.parent_names = list(names)
+        self.has_parents = bool(brand_index.parents)
+
+    def ambiguity_scores(self, frequencies):
+        """按关键词语料的整词文档频率为每个词条打分（见 token_frequencies），一次向量化计算
+
+        词条的得分为其各整词出现比例中的最小值，即包含该词条的关键词比例的上界；
+        正则规则和不含整词的词条得分为 0。
+        """
+        tokens = pd.Series(self.literals, dtype=object).str.findall(token_pattern(self.cjk)).explode()
+        shares = tokens.map(frequencies).astype(float).fillna(0.0)
+        return shares.groupby(level=0).min().reindex(range(len(self.terms)), fill_value=0.0).to_numpy()
+
+    def term_confidence(self, scores=None):
+        """预先计算每个词条命中时的置信度：类型基础分 × 词长系数 × 歧义系数
+
+        词长系数为 0.5 + 词长 / 10（不超过 1，正则规则取 1）；scores 为 ambiguity_scores 的结果，
+        品牌词库词条按歧义得分折扣，最多折半。
+        """
+        kinds = [
+            'manual' if kind == 'exact' and source == 0 else kind for kind, source in zip(self.kinds, self.sources)
+        ]
+        base = np.array([KIND_CONFIDENCE[kind] for kind in kinds], dtype=float)
+        lengths = np.array([len(term) for term in self.literals], dtype=float)
+        length_factor = np.where(np.array(self.kinds) == 'regex', 1.0, np.minimum(1.0, 0.5 + lengths / 10))
+        if scores is None:
+            return base * length_factor
+        discount = 0.5 * np.minimum(1.0, np.asarray(scores, dtype=float) / AMBIGUITY_SCALE)
+        ambiguity_factor = np.where(np.array(self.sources) == 1, 1.0 - discount, 1.0)
+        return base * length_factor * ambiguity_factor
+
+    def ambiguous_terms(self, scores, threshold):
+        """返回得分超过阈值的品牌词库词条（手动规则由用户指定，不参与歧义判断）"""
+        return {
+            term for term, source, score in zip(self.terms, self.sources, scores)
+            if source == 1 and score > threshold
+        }
+
+    def _guard(self, matcher):
+        """词表含有排除语境时，在匹配引擎外层加上排除语境过滤"""
+        vetoes = {
+            term_id: keys for term_id, (kind, keys) in enumerate(zip(self.kinds, self.veto_keys))
+            if kind == 'exclusion'
+        }
+        if not vetoes:
+            return matcher
+        guards = [None if term_id in vetoes else key for term_id, key in enumerate(self.veto_keys)]
+        return ExclusionMatcher(matcher, guards, vetoes)
+
+    def _build_token_filter(self):
+        """用会产生命中的词条（排除语境只作废命中，不计入）构建整词位图，无法按整词筛选时返回 None"""
+        terms = [term for term, kind in zip(self.terms, self.kinds) if kind != 'exclusion']
+        token_re = token_pattern(self.cjk)
+        if self.regex_matcher is not None or not all(token_re.search(term) for term in terms):
+            return None
+        return TokenFilter(terms, self.cjk)
+
+    def collapsed_matcher(self):
+        """返回分隔符折叠索引，首次使用时构建并随词表一起缓存"""
+        if self._collapsed_matcher is None:
+            self._collapsed_matcher = self._guard(CollapsedMatcher(self.literals, self.tiers, self.cjk))
+        return self._collapsed_matcher
+
+    def regex_runner(self):
+        """返回正则规则的子进程执行器，供多批关键词复用；没有正则规则时为 None"""
+        return self.regex_matcher.runner() if self.regex_matcher is not None else None
+
+    def prepared_matcher(self, keywords, runner=None):
+        """返回匹配这批关键词使用的匹配器及超时停用的正则规则列表
+
+        有正则规则时先在子进程中带超时执行一遍（见 RegexRuleMatcher.prepare），词表本身不保存本次结果，
+        可在多个会话间共享。
+        """
+        if self.regex_matcher is None:
+            return self.matcher, []
+        prepared, exhausted = self.regex_matcher.prepare(keywords, runner)
+        return self._guard(prepared), [self.terms[term_id] for term_id in exhausted]
+
+    def fuzzy_matcher(self, max_distance):
+        """返回模糊匹配索引（只包含原词条），首次使用时构建并随词表一起缓存"""
+        if max_distance not in self._fuzzy_matchers:
+            count = self.exact_count
+            self._fuzzy_matchers[max_distance] = FuzzyMatcher(
+                self.literals[:count], self.tiers[:count], max_distance, cjk=self.cjk
+            )
+        return self._fuzzy_matchers[max_distance]
+
+
+# 进程池中每个工作进程持有的匹配器，由初始化函数构建一次
+_worker_matcher = None
+
+
+def _init_worker(matcher):
+    """工作进程初始化：保存匹配器供后续分块使用"""
+    global _worker_matcher
+    _worker_matcher = matcher
+
+
+def _match_chunk(task):
+    """在工作进程中对一个关键词分块逐个调用匹配器的指定方法"""
+    method, keywords = task
+    func = getattr(_worker_matcher, method)
+    return [func(keyword) for keyword in keywords]
+
+
+def _map_keywords(method, keywords, matcher, workers=1, chunk_size=20000, min_parallel_size=50000):
+    """对每个关键词调用匹配器的 method 方法（match 或 find_all），按原顺序返回结果列表
+
+    workers 大于 1 且关键词数不少于 min_parallel_size 时，按 chunk_size 分块交给进程池并行匹配，
+    结果按原顺序拼接；否则在当前进程串行匹配。
+    工作进程以 spawn 方式启动：调用方（如 Streamlit 服务）是多线程进程，fork 可能继承被其他线程持有的锁而死锁；
+    匹配器通过 __reduce__ 在工作进程中重建。
+    """
+    if workers > 1 and len(keywords) >= min_parallel_size:
+        chunks = [(method, list(keywords[i:i + chunk_size])) for i in range(0, len(keywords), chunk_size)]
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker,
+            initargs=(matcher,)
+        ) as executor:
+            # 工作进程在提交任务时启动，map 会立即提交全部分块
+            with _spawn_without_main():
+                results = executor.map(_match_chunk, chunks)
+            return [result for chunk in results for result in chunk]
+    func = getattr(matcher, method)
+    return [func(keyword) for keyword in keywords]
+
+
+def match_unique(keywords, matcher, resolve='priority', **kwargs):
+    """逐个匹配已去重的关键词，返回 (命中词条序号数组, 命中起始位置数组)，未命中均为 -1
+
+    resolve 为命中选择方式，可选值见 RESOLVE_METHODS；其余参数同 _map_keywords。
+    """
+    results = _map_keywords(RESOLVE_METHODS[resolve], keywords, matcher, **kwargs)
+    found = np.array(results, dtype=np.int64).reshape(-1, 2)
+    return found[:, 0], found[:, 1]
+
+
+def find_unique(keywords, matcher, **kwargs):
+    """找出每个已去重关键词中的全部品牌命中，其余参数同 _map_keywords
+
+    返回长表：pos 为关键词下标，start/end 为命中在关键词中的起止位置，term_id 为词条序号。
+    """
+    results = _map_keywords('find_all', keywords, matcher, **kwargs)
+    spans = np.array([hit for hits in results for hit in hits], dtype=np.int64).reshape(-1, 3)
+    return pd.DataFrame({
+        'pos': np.repeat(np.arange(len(results)), [len(hits) for hits in results]),
+        'start': spans[:, 0],
+        'end': spans[:, 1],
+        'term_id': spans[:, 2],
+    })
+
+
+def _first_hits(all_hits, size, resolve='priority', tiers=None):
+    """从全部命中长表中为每个关键词选出一个命中，返回 (命中词条序号数组, 命中起始位置数组)，未命中均为 -1
+
+    priority 取序号最小的词条（起始位置取该词条最靠前的命中）；leftmost_longest 按 (层级, 起始位置, -长度, 序号) 取最小者。
+    """
+    if resolve == 'leftmost_longest':
+        ranked = all_hits.assign(
+            tier=np.asarray(tiers, dtype=np.int64)[all_hits['term_id'].to_numpy()],
+            neg_length=all_hits['start'] - all_hits['end'],
+        )
+        first = ranked.sort_values(['pos', 'tier', 'start', 'neg_length', 'term_id'])
+    else:
+        first = all_hits.sort_values(['pos', 'term_id', 'start'])
+    first = first.drop_duplicates('pos')
+    positions = first['pos'].to_numpy()
+    unique_hits = np.full(size, -1, dtype=np.int64)
+    unique_starts = np.full(size, -1, dtype=np.int64)
+    unique_hits[positions] = first['term_id'].to_numpy()
+    unique_starts[positions] = first['start'].to_numpy()
+    return unique_hits, unique_starts
+
+
+def token_frequencies(keywords, cjk=False):
+    """统计关键词语料的整词文档频率：每个整词出现在多少比例的去重关键词中（Series：整词 -> 比例）"""
+    uniques = pd.Series(pd.unique(pd.Series(keywords, dtype=object)), dtype=object)
+    tokens = uniques.str.findall(token_pattern(cjk)).explode().dropna()
+    postings = pd.DataFrame({'token': tokens.to_numpy(), 'pos': tokens.index.to_numpy()}).drop_duplicates()
+    return postings['token'].value_counts() / max(len(uniques), 1)
+
+
+def share_of_search(codes, volumes, names):
+    """按整数编码汇总搜索量份额，返回包含 name/volume/share 的表，按搜索量降序
+
+    codes 为每一行的编码（-1 表示未命中，只计入总搜索量），names 为编码对应的名称。
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    volumes = np.asarray(volumes, dtype=float)
+    matched = codes >= 0
+    totals = np.bincount(codes[matched], weights=volumes[matched], minlength=len(names))
+    total = volumes.sum()
+    table = pd.DataFrame({'name': names, 'volume': totals, 'share': totals / total if total else 0.0})
+    return table[table['volume'] > 0].sort_values('volume', ascending=False, ignore_index=True)
+
+
+def _first_ids(terms):
+    """返回 词条 -> 首次出现的序号（忽略空词条）"""
+    first_ids = {}
+    for term_id, term in enumerate(terms):
+        if term:
+            first_ids.setdefault(term, term_id)
+    return first_ids
+
+
+def _longest_increasing(values):
+    """返回最长递增子序列在 values 中的下标集合"""
+    tails = []
+    tail_index = []
+    previous = [-1] * len(values)
+    for i, value in enumerate(values):
+        pos = bisect_left(tails, value)
+        if pos == len(tails):
+            tails.append(value)
+            tail_index.append(i)
+        else:
+            tails[pos] = value
+            tail_index[pos] = i
+        previous[i] = tail_index[pos - 1] if pos else -1
+    kept = set()
+    i = tail_index[-1] if tail_index else -1
+    while i >= 0:
+        kept.add(i)
+        i = previous[i]
+    return kept
+
+
+def diff_terms(old_terms, new_terms, old_tiers=None, new_tiers=None):
+    """比较新旧两份按优先级排列的词条列表
+
+    新旧都存在、层级相同且相对顺序不变的词条（取最长递增子序列）视为未变化；其余新词条可能抢走命中，
+    其余旧词条的命中可能失效。返回 (新增或移动的词条集合, 删除或移动的词条集合)。
+    """
+    old_ids = _first_ids(old_terms)
+    new_ids = _first_ids(new_terms)
+    old_tiers = old_tiers or [0] * len(old_terms)
+    new_tiers = new_tiers or [0] * len(new_terms)
+    common = [
+        term for term in old_ids
+        if term in new_ids and old_tiers[old_ids[term]] == new_tiers[new_ids[term]]
+    ]
+    stable = {common[i] for i in _longest_increasing([new_ids[term] for term in common])}
+    added = {term for term in new_ids if term not in stable}
+    removed = {term for term in old_ids if term not in stable}
+    return added, removed
+
+
+# 补充匹配的种类，按尝试顺序排列；MatchState.unique_fallback 中 0 表示没有使用补充匹配，
+# i 表示由第 i 种补充匹配命中
+FALLBACK_KINDS = ('collapsed', 'fuzzy')
+# 补充匹配命中的置信度系数
+FALLBACK_CONFIDENCE = {'collapsed': 0.9, 'fuzzy': 0.6}
+# 品牌词不在关键词开头时的置信度系数
+POSITION_CONFIDENCE = 0.9
+
+
+class MatchState:
+    """一次匹配的去重关键词及其命中结果，规则或词库变化时只重新匹配受影响的关键词
+
+    key 用于判断关键词数据是否与上次相同，由调用方传入（如关键词列的内容指纹）。
+    collect_all 为 True 时在同一次扫描中保留每个关键词的全部命中及其起止位置（all_hits 长表），
+    每个关键词最终归属的命中由全部命中按 resolve 选出。
+    resolve 为命中选择方式，可选值见 RESOLVE_METHODS。
+    没有精确命中的关键词依次尝试补充匹配：collapse 为 True 时忽略空格和连字符再匹配，
+    fuzzy 为模糊匹配允许的最大编辑距离（0 表示关闭）。按最左最长选择时折叠命中还与精确命中一起比较。
+    补充命中的种类记录在 unique_fallback 中，不计入 all_hits。
+    unique_starts 为每个去重关键词归属命中在关键词中的起始位置（未命中为 -1），由匹配引擎与命中一并返回。
+    词表有整词位图（token_filter）时，首次匹配只把可能命中的关键词交给匹配引擎，
+    prefiltered 记录被位图直接判定为未命中的去重关键词数（无法按整词筛选时为 None）。
+    exhausted_rules 为本次匹配中超时、在全部关键词上都未使用的正则规则，每次匹配重新判断。
+    regex_runner 为复用的正则规则执行器（见 BrandLexicon.regex_runner），为 None 时临时启动。
+    """
+
+    def __init__(self, keywords, lexicon, workers=1, key=None, collect_all=False, resolve='priority', fuzzy=0,
+                 collapse=False, regex_runner=None):
+        self.key = key
+        self.collect_all = collect_all
+        self.resolve = resolve
+        self.fuzzy = fuzzy
+        self.collapse = collapse
+        self.codes, self.uniques = pd.factorize(keywords)
+        self.lexicon = lexicon
+        matcher, self.exhausted_rules = lexicon.prepared_matcher(self.uniques, regex_runner)
+        # 不含任何品牌词整词的关键词不可能有精确命中，整列筛掉后只匹配其余关键词
+        if lexicon.token_filter is None:
+            positions = np.arange(len(self.uniques))
+            self.prefiltered = None
+        else:
+            positions = lexicon.token_filter.candidates(self.uniques)
+            self.prefiltered = len(self.uniques) - len(positions)
+        if collect_all:
+            self.all_hits = find_unique(self.uniques[positions], matcher, workers=workers)
+            self.all_hits['pos'] = positions[self.all_hits['pos'].to_numpy()]
+            self.unique_hits, self.unique_starts = _first_hits(
+                self.all_hits, len(self.uniques), resolve, lexicon.tiers
+            )
+        else:
+            self.all_hits = None
+            self.unique_hits = np.full(len(self.uniques), -1, dtype=np.int64)
+            self.unique_starts = np.full(len(self.uniques), -1, dtype=np.int64)
+            self.unique_hits[positions], self.unique_starts[positions] = match_unique(
+                self.uniques[positions], matcher, resolve=resolve, workers=workers
+            )
+        self.unique_fallback = np.zeros(len(self.uniques), dtype=np.int8)
+        self._token_index = None
+        self._match_fallback(np.arange(len(self.uniques)), matcher, workers)
+
+    @property
+    def hit_ids(self):
+        """每一行命中的词条序号，未命中为 -1"""
+        return self.unique_hits[self.codes]
+
+    @property
+    def fallback_codes(self):
+        """每一行的补充匹配种类（FALLBACK_KINDS 中的序号加 1），0 表示没有使用补充匹配"""
+        return self.unique_fallback[self.codes]
+
+    def confidence(self, term_confidence):
+        """按每个去重关键词的命中一次向量化算出置信度，回填到每一行，未命中为 0
+
+        term_confidence 为每个词条的置信度（见 BrandLexicon.term_confidence），再乘以补充匹配系数；
+        归属命中不在关键词开头（unique_starts 大于 0）时乘以 POSITION_CONFIDENCE。
+        """
+        hits = self.unique_hits
+        matched = np.flatnonzero(hits >= 0)
+        fallback_factor = np.array([1.0] + [FALLBACK_CONFIDENCE[kind] for kind in FALLBACK_KINDS])
+        scores = np.zeros(len(self.uniques))
+        scores[matched] = (
+            np.asarray(term_confidence, dtype=float)[hits[matched]]
+            * fallback_factor[self.unique_fallback[matched]]
+            * np.where(self.unique_starts[matched] > 0, POSITION_CONFIDENCE, 1.0)
+        )
+        return scores[self.codes]
+
+    def _fallback_matchers(self):
+        """返回启用的补充匹配 (种类编号, 匹配器)，按尝试顺序排列"""
+        stages = []
+        if self.collapse:
+            stages.append((FALLBACK_KINDS.index('collapsed') + 1, self.lexicon.collapsed_matcher()))
+        if self.fuzzy:
+            stages.append((FALLBACK_KINDS.index('fuzzy') + 1, self.lexicon.fuzzy_matcher(self.fuzzy)))
+        return stages
+
+    def _match_fallback(self, positions, matcher, workers=1):
+        """对给定下标的关键词做补充匹配，返回重新判断过的关键词下标
+
+        没有精确命中的关键词依次尝试各补充匹配；按最左最长选择时，有精确命中的关键词再与折叠命中比较一次，
+        折叠命中更靠前或更长时改用折叠命中。matcher 为本次精确匹配使用的匹配器。
+        """
+        matched = [np.empty(0, dtype=np.int64)]
+        for code, fallback in self._fallback_matchers():
+            if FALLBACK_KINDS[code - 1] == 'collapsed' and self.resolve == 'leftmost_longest':
+                rivals = positions[(self.unique_hits[positions] >= 0) & (self.unique_fallback[positions] == 0)]
+                if len(rivals):
+                    found, starts = match_unique(
+                        self.uniques[rivals], CompetingCollapsedMatcher(matcher, fallback), resolve=self.resolve,
+                        workers=workers
+                    )
+                    won = found >= len(matcher.terms)
+                    self.unique_hits[rivals[won]] = found[won] - len(matcher.terms)
+                    self.unique_starts[rivals[won]] = starts[won]
+                    self.unique_fallback[rivals[won]] = code
+                    matched.append(rivals)
+            positions = positions[self.unique_hits[positions] < 0]
+            if len(positions) == 0:
+                break
+            found, starts = match_unique(self.uniques[positions], fallback, resolve=self.resolve, workers=workers)
+            self.unique_hits[positions] = found
+            self.unique_starts[positions] = starts
+            self.unique_fallback[positions] = np.where(found >= 0, code, 0)
+            matched.append(positions)
+        return np.unique(np.concatenate(matched))
+
+    def _fallback_candidates(self, terms):
+        """返回可能通过补充匹配命中给定词条的去重关键词下标，无法通过索引筛选时返回 None"""
+        found = [np.empty(0, dtype=np.int64)]
+        if self.collapse:
+            collapsed = self._collapsed_candidates(terms)
+            if collapsed is None:
+                return None
+            found.append(collapsed)
+        if self.fuzzy:
+            found.append(self._fuzzy_candidates(terms))
+        return np.unique(np.concatenate(found))
+
+    def _collapsed_candidates(self, terms):
+        """返回折叠后可能命中给定词条的去重关键词下标
+
+        折叠命中在原文中从某个整词的开头开始，该整词不含分隔符，因而是折叠后词条的前缀，
+        只需取折叠词条各个前缀的倒排列表。折叠词条不以单词字符开头时返回 None。
+        """
+        found = [np.empty(0, dtype=np.int64)]
+        for term in terms:
+            collapsed, _ = collapse_separators(term)
+            if not collapsed:
+                continue
+            if not is_word_char(collapsed[0]):
+                return None
+            found.extend(self._token_postings(collapsed[:size]) for size in range(1, len(collapsed) + 1))
+        return np.unique(np.concatenate(found))
+
+    def _fuzzy_candidates(self, terms):
+        """返回含有与给定词条在容错距离内的整词的去重关键词下标"""
+        matcher = FuzzyMatcher(list(terms), max_distance=self.fuzzy, cjk=self.lexicon.cjk)
+        if not matcher.deletes:
+            return np.empty(0, dtype=np.int64)
+        groups, _ = self._token_groups()
+        near = [self._token_postings(token) for token in groups if matcher.lookup(token)]
+        return np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + near))
+
+    def row_hits(self):
+        """把全部命中长表展开到每一行，返回包含 row/start/end/term_id 的长表"""
+        rows = pd.DataFrame({'row': np.arange(len(self.codes)), 'pos': self.codes})
+        long_hits = rows.merge(self.all_hits, on='pos').drop(columns='pos')
+        return long_hits.sort_values(['row', 'start', 'end'], ignore_index=True)
+
+    def _token_groups(self):
+        """返回整词倒排索引 (整词 -> 行号数组, 行号对应的去重关键词下标)，首次调用时建立"""
+        if self._token_index is None:
+            token_re = token_pattern(self.lexicon.cjk)
+            tokens = pd.Series(self.uniques, dtype=object).str.findall(token_re).explode().dropna()
+            postings = pd.DataFrame({'token': tokens.to_numpy(), 'pos': tokens.index.to_numpy()}).drop_duplicates()
+            self._token_index = (postings.groupby('token').indices, postings['pos'].to_numpy())
+        return self._token_index
+
+    def _token_postings(self, token):
+        """返回包含某个整词的去重关键词下标"""
+        groups, positions = self._token_groups()
+        rows = groups.get(token)
+        return positions[rows] if rows is not None else np.empty(0, dtype=np.int64)
+
+    def candidates(self, terms):
+        """返回可能命中给定词条的去重关键词下标
+
+        与 TokenFilter 同理，只需取词条中最少见整词的倒排列表。
+        不含任何整词的词条无法通过索引筛选，返回 None 表示需要全部重新匹配。
+        """
+        found = [np.empty(0, dtype=np.int64)]
+        for term in terms:
+            tokens = token_pattern(self.lexicon.cjk).findall(term)
+            if not tokens:
+                return None
+            found.append(min((self._token_postings(token) for token in tokens), key=len))
+        return np.unique(np.concatenate(found))
+
+    def rematch(self, lexicon, workers=1):
+        """切换到新的匹配词表，只重新匹配受影响的关键词，返回重新匹配的关键词数"""
+        if lexicon.cjk != self.lexicon.cjk:
+            raise ValueError("边界规则不同的词表无法增量匹配")
+        # 受排除语境约束的品牌发生变化的词条同样视为移动
+        added, removed = diff_terms(
+            self.lexicon.terms, lexicon.terms,
+            list(zip(self.lexicon.levels, self.lexicon.veto_keys)), list(zip(lexicon.levels, lexicon.veto_keys))
+        )
+        old_terms = self.lexicon.terms
+        # 删除的排除语境会让原先被作废的命中恢复，与新增词条一样需要找出包含它的关键词
+        old_exclusions = {term for term, kind in zip(old_terms, self.lexicon.kinds) if kind == 'exclusion'}
+        changed = added | (removed & old_exclusions)
+        # 新增的正则规则无法通过整词索引筛选，需要全部重新匹配
+        new_patterns = {term for term, kind in zip(lexicon.terms, lexicon.kinds) if kind == 'regex'}
+        # 正则规则每次都在全部关键词上重新执行，停用的规则与上次不同时保留的命中也可能失效
+        matcher, exhausted_rules = lexicon.prepared_matcher(self.uniques)
+
+        # 补充命中先清空，精确匹配更新后再重新判断
+        previous_fallback = np.flatnonzero(self.unique_fallback)
+        self.unique_hits[previous_fallback] = -1
+        self.unique_starts[previous_fallback] = -1
+        self.unique_fallback[:] = 0
+        new_ids = _first_ids(lexicon.terms)
+
+        # 旧命中换算为新词表中的序号，失效的旧命中需要重新匹配
+        old_to_new = np.array([new_ids.get(term, -1) for term in old_terms] + [-1], dtype=np.int64)
+        invalid = np.array([term in removed for term in old_terms] + [False])
+        hits = old_to_new[self.unique_hits]
+        if self.all_hits is None:
+            affected = np.flatnonzero(invalid[self.unique_hits])
+        else:
+            # 保留全部命中时，任一命中失效的关键词都需要重新扫描
+            term_ids = self.all_hits['term_id'].to_numpy()
+            affected = np.unique(self.all_hits['pos'].to_numpy()[invalid[term_ids]])
+
+        # 新增词条可能抢走命中：通过倒排索引找到包含其整词的关键词
+        if changed & new_patterns or exhausted_rules != self.exhausted_rules:
+            candidates = None
+        else:
+            candidates = self.candidates(changed)
+        if candidates is None:
+            affected = np.arange(len(self.uniques))
+        else:
+            affected = np.union1d(affected, candidates)
+
+        if self.all_hits is None:
+            if self.collapse and self.resolve == 'leftmost_longest':
+                # 折叠命中可能胜过了精确命中，清空后需要重新取得精确命中
+                affected = np.union1d(affected, previous_fallback)
+            hits[affected], self.unique_starts[affected] = match_unique(
+                self.uniques[affected], matcher, resolve=self.resolve, workers=workers
+            )
+            self.unique_hits = hits
+        else:
+            kept = self.all_hits[~np.isin(self.all_hits['pos'].to_numpy(), affected)]
+            kept = kept.assign(term_id=old_to_new[kept['term_id'].to_numpy()])
+            found = find_unique(self.uniques[affected], matcher, workers=workers)
+            found['pos'] = affected[found['pos'].to_numpy()]
+            self.all_hits = pd.concat([kept, found], ignore_index=True)
+            self.unique_hits, self.unique_starts = _first_hits(
+                self.all_hits, len(self.uniques), self.resolve, lexicon.tiers
+            )
+        self.lexicon = lexicon
+        self.exhausted_rules = exhausted_rules
+
+        # 补充匹配：原补充命中、本次受影响以及可能通过补充匹配命中新增词条的关键词需要重新判断
+        if self.collapse or self.fuzzy:
+            candidates = self._fallback_candidates(changed - new_patterns)
+            if candidates is None:
+                candidates = np.arange(len(self.uniques))
+            positions = np.union1d(np.union1d(previous_fallback, affected), candidates)
+            affected = np.union1d(affected, self._match_fallback(positions, matcher, workers))
+        return len(affected)
+
+
+# 词条来源类型 -> 结果表中的匹配方式
+MATCH_KIND_LABELS = {
+    'exact': '精确',
+    'regex': '正则',
+    'variant': '变体',
+    'collapsed': '折叠',
+    'fuzzy': '模糊',
+    'exclusion': '排除',
+}
+
+
+def result_columns(state, term_confidence):
+    """按匹配结果一次性生成每一行的结果列：品牌名称、品牌、词性、匹配方式、置信度"""
+    lexicon = state.lexicon
+    hit_ids = state.hit_ids
+    # 末尾追加 None 作为未命中（-1）的占位
+    term_kinds = np.array([MATCH_KIND_LABELS[kind] for kind in lexicon.kinds] + [None], dtype=object)
+    fallback_kinds = np.array([None] + [MATCH_KIND_LABELS[kind] for kind in FALLBACK_KINDS], dtype=object)
+    fallback = state.fallback_codes
+    return {
+        '品牌名称': np.array(lexicon.brands + [None], dtype=object)[hit_ids],
+        '品牌': np.array(lexicon.terms + [None], dtype=object)[hit_ids],
+        '词性': np.where(hit_ids >= 0, 'Branded KWs', 'Non-Branded KWs'),
+        '匹配方式': np.where(fallback > 0, fallback_kinds[fallback], term_kinds[hit_ids]),
+        '置信度': state.confidence(term_confidence).round(2),
+    }
+
+
+def read_keyword_chunks(source, chunk_size=100000, skiprows=2):
+    """按块读取 CSV 或 xlsx 关键词文件，逐块产出 DataFrame，不把整个文件读入内存
+
+    source 为文件路径或带 name 属性的文件对象（如上传文件），按扩展名判断格式；
+    skiprows 为表头之前跳过的行数，默认与产品关键词导出文件一致（前两行为说明）。
+    xlsx 以只读模式逐行读取第一个工作表。
+    """
+    name = str(getattr(source, 'name', source)).lower()
+    if name.endswith('.csv'):
+        yield from pd.read_csv(source, skiprows=skiprows, chunksize=chunk_size)
+        return
+    from openpyxl import load_workbook
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(min_row=skiprows + 1, values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [str(column) for column in header]
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= chunk_size:
+                yield pd.DataFrame(batch, columns=header)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=header)
+    finally:
+        workbook.close()
+
+
+def match_keyword_chunks(chunks, lexicon, keyword_column='关键词', workers=1, resolve='priority', fuzzy=0,
+                         collapse=False, term_confidence=None):
+    """流式匹配：逐块匹配关键词，逐块产出追加了结果列（见 result_columns）的数据块
+
+    chunks 为 DataFrame 的可迭代对象（如 read_keyword_chunks 或 pd.read_csv(..., chunksize=...)），
+    每块处理完即可释放，峰值内存只与块大小和词表有关。块内相同关键词只匹配一次，块之间不共享结果。
+    term_confidence 为每个词条的置信度，默认按词条来源计算（流式读取时拿不到整个语料，不计歧义）。
+    正则规则在各块之间共用一个子进程；已写出的数据块无法撤回，某条规则超时时抛出 ValueError 终止整次匹配。
+    """
+    if term_confidence is None:
+        term_confidence = lexicon.term_confidence()
+    runner = lexicon.regex_runner()
+    try:
+        for chunk in chunks:
+            if keyword_column not in chunk.columns:
+                raise ValueError(f"数据块中缺少“{keyword_column}”列")
+            state = MatchState(
+                normalize_series(chunk[keyword_column]), lexicon, workers=workers, resolve=resolve, fuzzy=fuzzy,
+                collapse=collapse, regex_runner=runner
+            )
+            if state.exhausted_rules:
+                raise ValueError(f"正则规则匹配超时：{', '.join(state.exhausted_rules)}，请修改或删除后重试")
+            yield chunk.assign(**result_columns(state, term_confidence))
+    finally:
+        if runner is not None:
+            runner.close()